@@ -5,11 +5,33 @@ human-editable representation of Bril programs. There are two commands:
 `bril2txt`, which takes a Bril program in its (canonical) JSON format and
 pretty-prints it in the text format, and `bril2json`, which parses the
 format and emits the ordinary JSON representation.
+
+There are three parser engines: Lark's Earley and LALR engines, which
+share a grammar, and a hand-written recursive-descent parser that needs
+no dependencies and builds the JSON directly without a parse tree.
+`bril2json` uses the LALR engine by default, whose compiled parser table
+is cached on disk (under `$XDG_CACHE_HOME/bril`) so that later runs skip
+grammar compilation. Pick another engine with `--parser=<engine>` or the
+`BRIL_PARSER` environment variable.
 """
 
-import lark
 import sys
 import json
+import hashlib
+import os
+import re
+import io
+import struct
+import itertools
+import mmap
+import stat
+import concurrent.futures
+from collections.abc import MutableMapping
+
+try:
+    import lark
+except ImportError:  # Only the hand-written parser is available.
+    lark = None
 
 __version__ = '0.0.1'
 
@@ -19,7 +41,7 @@ __version__ = '0.0.1'
 GRAMMAR = """
 start: func*
 
-func: FUNC ["(" arg_list? ")"] [tyann] "{" instr* "}"
+func: FUNC ["(" arg_list ")"] [tyann] "{" instr* "}"
 arg_list: | arg ("," arg)*
 arg: IDENT ":" type
 ?instr: const | vop | eop | label
@@ -56,7 +78,7 @@ COMMENT: /#.*/
 """.strip()
 
 
-class JSONTransformer(lark.Transformer):
+class JSONTransformer(lark.Transformer if lark else object):
     def start(self, items):
         return {'functions': items}
 
@@ -155,11 +177,392 @@ class JSONTransformer(lark.Transformer):
         return float(items[0])
 
 
-def parse_bril(txt):
-    parser = lark.Lark(GRAMMAR, maybe_placeholders=True)
-    tree = parser.parse(txt)
-    data = JSONTransformer().transform(tree)
-    return json.dumps(data, indent=2, sort_keys=True)
+def _cache_path():
+    """Get the file for storing the serialized LALR parser table. The
+    name includes a hash of the grammar and the Lark version, so editing
+    either one never loads a stale table. (Only newer Lark releases
+    check this themselves.)
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    key = hashlib.sha256(
+        '{}\0{}'.format(lark.__version__, GRAMMAR).encode('utf-8')
+    ).hexdigest()[:16]
+    return os.path.join(base, 'bril', 'briltxt-lalr-{}.cache'.format(key))
+
+
+def _lalr_parser():
+    """Build the LALR parser, loading its table from the on-disk cache
+    when possible.
+    """
+    path = _cache_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return lark.Lark(GRAMMAR, parser='lalr', maybe_placeholders=True,
+                         cache=path)
+    except OSError:
+        # The cache is unwritable; just compile the grammar every time.
+        return lark.Lark(GRAMMAR, parser='lalr', maybe_placeholders=True)
+
+
+# Parsers are expensive to build, so we build each one once per process.
+_PARSERS = {}
+
+
+def get_parser(engine='earley'):
+    """Get a Lark parser for the text format using `engine`, which is
+    either 'earley' or 'lalr'.
+    """
+    if lark is None:
+        raise ImportError('the {} parser requires lark'.format(engine))
+    if engine not in _PARSERS:
+        if engine == 'lalr':
+            _PARSERS[engine] = _lalr_parser()
+        elif engine == 'earley':
+            _PARSERS[engine] = lark.Lark(GRAMMAR, maybe_placeholders=True)
+        else:
+            raise ValueError('unknown parser engine {}'.format(engine))
+    return _PARSERS[engine]
+
+
+# Hand-written parser. This accepts the same language as `GRAMMAR` and
+# produces the same JSON as `JSONTransformer`, but in a single pass.
+
+_IDENT = r'[_%A-Za-z][_%.A-Za-z0-9]*'
+TOKEN_RE = re.compile(r'''
+    (?P<ws>\s+|\#.*)
+  | (?P<func>@{ident})
+  | (?P<float>[0-9]+\.[0-9]*|\.[0-9]+)
+  | (?P<label>\.{ident})
+  | (?P<int>[+-]?[0-9]+)
+  | (?P<ident>{ident})
+  | (?P<punct>[(){{}}<>:;,=])
+  | (?P<error>.)
+'''.format(ident=_IDENT), re.VERBOSE)
+
+
+class BrilSyntaxError(ValueError):
+    """A syntax error in Bril source text.
+    """
+    def __init__(self, line, column, msg):
+        self.line = line
+        self.column = column
+        super(BrilSyntaxError, self).__init__('line {}, column {}: {}'.format(
+            line, column, msg,
+        ))
+
+
+def tokenize(lines):
+    """Generate `(kind, text, (line, column))` tokens for Bril source
+    text, given as an iterable of lines, skipping whitespace and
+    comments. Punctuation tokens have their own text as their kind. A
+    final token of kind `'eof'` marks the end of the input.
+
+    No token spans a line break, so this consumes its input one line at
+    a time.
+    """
+    lineno = 0
+    for lineno, line in enumerate(lines, 1):
+        for match in TOKEN_RE.finditer(line):
+            kind = match.lastgroup
+            if kind == 'ws':
+                continue
+            text = match.group()
+            if kind == 'punct':
+                kind = text
+            elif kind == 'error':
+                raise BrilSyntaxError(
+                    lineno, match.start() + 1,
+                    'unexpected character {!r}'.format(text),
+                )
+            yield kind, text, (lineno, match.start() + 1)
+    yield 'eof', '', (lineno + 1, 1)
+
+
+class Parser:
+    """A recursive-descent parser for the Bril text format, which reads
+    source text (a string or an iterable of lines, such as a file).
+
+    Call `funcs` to generate the program's functions one at a time, as
+    soon as each one is parsed.
+    """
+    def __init__(self, txt):
+        if isinstance(txt, str):
+            txt = io.StringIO(txt)
+        self.tokens = tokenize(txt)
+        self.kind, self.text, self.pos = next(self.tokens)
+
+    def advance(self):
+        """Move to the next token and return the text of the old one.
+        """
+        text = self.text
+        self.kind, self.text, self.pos = next(self.tokens)
+        return text
+
+    def error(self, expected):
+        got = repr(self.text) if self.text else 'end of input'
+        return BrilSyntaxError(self.pos[0], self.pos[1],
+                               'expected {}, got {}'.format(expected, got))
+
+    def expect(self, kind):
+        """Consume a token of the given kind and return its text.
+        """
+        if self.kind != kind:
+            raise self.error(kind)
+        return self.advance()
+
+    def funcs(self):
+        while self.kind != 'eof':
+            yield self.func()
+
+    def prog(self):
+        return {'functions': list(self.funcs())}
+
+    def func(self):
+        name = self.expect('func')[1:]  # Strip `@`.
+        args = []
+        if self.kind == '(':
+            self.advance()
+            if self.kind != ')':
+                args.append(self.arg())
+                while self.kind == ',':
+                    self.advance()
+                    args.append(self.arg())
+            self.expect(')')
+        typ = None
+        if self.kind == ':':
+            self.advance()
+            typ = self.type()
+        self.expect('{')
+        instrs = []
+        while self.kind != '}':
+            instrs.append(self.instr())
+        self.advance()
+
+        func = {
+            'name': name,
+            'instrs': instrs,
+        }
+        if args:
+            func['args'] = args
+        if typ:
+            func['type'] = typ
+        return func
+
+    def arg(self):
+        name = self.expect('ident')
+        self.expect(':')
+        return {
+            'name': name,
+            'type': self.type(),
+        }
+
+    def type(self):
+        name = self.expect('ident')
+        if self.kind == '<':
+            self.advance()
+            param = self.type()
+            self.expect('>')
+            return {name: param}
+        return name
+
+    def instr(self):
+        if self.kind == 'label':
+            name = self.advance()[1:]  # Strip `.`.
+            self.expect(':')
+            return {'label': name}
+
+        first = self.expect('ident')
+        if self.kind not in (':', '='):
+            # An effect operation: `first` is the opcode.
+            return self.op(first)
+
+        typ = None
+        if self.kind == ':':
+            self.advance()
+            typ = self.type()
+        self.expect('=')
+
+        if self.kind == 'ident' and self.text == 'const':
+            self.advance()
+            out = {
+                'op': 'const',
+                'dest': first,
+                'value': self.lit(),
+            }
+            if typ:
+                out['type'] = typ
+            self.expect(';')
+            return out
+
+        out = {'dest': first}
+        if typ:
+            out['type'] = typ
+        out.update(self.op(self.expect('ident')))
+        return out
+
+    def op(self, opcode):
+        """Parse the operands of an operation through the closing `;`.
+        """
+        funcs = []
+        labels = []
+        args = []
+        while self.kind != ';':
+            if self.kind == 'ident':
+                args.append(self.advance())
+            elif self.kind == 'func':
+                funcs.append(self.advance()[1:])
+            elif self.kind == 'label':
+                labels.append(self.advance()[1:])
+            else:
+                raise self.error('operand or ;')
+        self.advance()
+
+        out = {'op': opcode}
+        if args:
+            out['args'] = args
+        if funcs:
+            out['funcs'] = funcs
+        if labels:
+            out['labels'] = labels
+        return out
+
+    def lit(self):
+        kind = self.kind
+        if kind == 'int':
+            return int(self.advance())
+        elif kind == 'float':
+            return float(self.advance())
+        elif kind == 'ident' and self.text in ('true', 'false'):
+            return self.advance() == 'true'
+        else:
+            raise self.error('literal')
+
+
+ENGINES = ('earley', 'lalr', 'handwritten')
+
+
+def parse_prog(txt, engine='earley'):
+    """Parse Bril source text into its JSON representation (as Python
+    data) using one of the `ENGINES`.
+    """
+    if engine == 'handwritten':
+        return Parser(txt).prog()
+    tree = get_parser(engine).parse(txt)
+    return JSONTransformer().transform(tree)
+
+
+def parse_bril(txt, engine='earley'):
+    return json.dumps(parse_prog(txt, engine), indent=2, sort_keys=True)
+
+
+# Streaming JSON. These read and write a program's JSON one function at a
+# time, so no more than one function needs to be in memory.
+
+def dump_funcs(funcs, out):
+    """Write a JSON program containing the functions from the iterable
+    `funcs` to the file `out`, flushing after each function. The output
+    is the same as `json.dumps(prog, indent=2, sort_keys=True)`.
+    """
+    out.write('{\n  "functions": [')
+    sep = '\n'
+    for func in funcs:
+        out.write(sep)
+        out.write('    ')
+        out.write(json.dumps(func, indent=2, sort_keys=True)
+                  .replace('\n', '\n    '))
+        out.flush()
+        sep = ',\n'
+    if sep != '\n':
+        out.write('\n  ')
+    out.write(']\n}\n')
+    out.flush()
+
+
+class JSONStream:
+    """An incremental reader for JSON values in a text file.
+    """
+    def __init__(self, fp, chunk_size=1 << 16):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Read more input, discarding consumed text. We read at least as
+        much as we have buffered so that re-decoding a large value after
+        each read takes linear time overall.
+        """
+        chunk = self.fp.read(max(self.chunk_size, len(self.buf) - self.pos))
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        self.eof = not chunk
+
+    def peek(self):
+        """Skip whitespace and return the next character ('' at EOF).
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self.fill()
+
+    def expect(self, chars):
+        """Consume the next character, which must be in `chars`.
+        """
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError('expected one of {!r} in JSON, got {!r}'.format(
+                chars, char,
+            ))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Decode the next complete JSON value.
+        """
+        self.peek()
+        while True:
+            try:
+                val, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if self.eof:
+                    raise
+            else:
+                # A number at the end of the buffer might continue.
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return val
+            self.fill()
+
+
+def load_funcs(fp):
+    """Generate the functions of a JSON Bril program read from the file
+    `fp`, decoding only one function at a time.
+    """
+    stream = JSONStream(fp)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        key = stream.value()
+        stream.expect(':')
+        if key == 'functions':
+            stream.expect('[')
+            if stream.peek() == ']':
+                stream.pos += 1
+            else:
+                while True:
+                    yield stream.value()
+                    if stream.expect(',]') == ']':
+                        break
+        else:
+            stream.value()  # Ignore anything else.
+        if stream.expect(',}') == '}':
+            return
 
 
 # Text format pretty-printer.
@@ -173,37 +576,47 @@ def type_to_str(type):
         return type
 
 
-def instr_to_string(instr):
-    if instr['op'] == 'const':
-        tyann = ': {}'.format(type_to_str(instr['type'])) \
-            if 'type' in instr else ''
-        return '{}{} = const {}'.format(
-            instr['dest'],
-            tyann,
-            str(instr['value']).lower(),
-        )
+def _dest_to_string(instr):
+    """Format the left-hand side of a value operation, including the
+    trailing ` = `.
+    """
+    if 'type' in instr:
+        return instr['dest'] + ': ' + type_to_str(instr['type']) + ' = '
     else:
-        rhs = instr['op']
-        if instr.get('funcs'):
-            rhs += ' {}'.format(' '.join(
-                '@{}'.format(f) for f in instr['funcs']
-            ))
-        if instr.get('args'):
-            rhs += ' {}'.format(' '.join(instr['args']))
-        if instr.get('labels'):
-            rhs += ' {}'.format(' '.join(
-                '.{}'.format(f) for f in instr['labels']
-            ))
-        if 'dest' in instr:
-            tyann = ': {}'.format(type_to_str(instr['type'])) \
-                if 'type' in instr else ''
-            return '{}{} = {}'.format(
-                instr['dest'],
-                tyann,
-                rhs,
-            )
-        else:
-            return rhs
+        return instr['dest'] + ' = '
+
+
+def _const_to_string(instr):
+    return _dest_to_string(instr) + 'const ' + str(instr['value']).lower()
+
+
+def _op_to_string(instr):
+    parts = [instr['op']]
+    funcs = instr.get('funcs')
+    if funcs:
+        parts.extend('@' + f for f in funcs)
+    args = instr.get('args')
+    if args:
+        parts.extend(args)
+    labels = instr.get('labels')
+    if labels:
+        parts.extend('.' + lbl for lbl in labels)
+    rhs = ' '.join(parts)
+    if 'dest' in instr:
+        return _dest_to_string(instr) + rhs
+    else:
+        return rhs
+
+
+# Formatters for opcodes that need special treatment. Everything else
+# uses `_op_to_string`.
+INSTR_FORMATTERS = {
+    'const': _const_to_string,
+}
+
+
+def instr_to_string(instr):
+    return INSTR_FORMATTERS.get(instr['op'], _op_to_string)(instr)
 
 
 def print_instr(instr):
@@ -224,31 +637,833 @@ def args_to_string(args):
         return ''
 
 
-def print_func(func):
+def func_to_text(func):
+    """Render a function in the text format as a single string.
+    """
     typ = func.get('type', 'void')
-    print('@{}{}{} {{'.format(
+    lines = ['@{}{}{} {{\n'.format(
         func['name'],
         args_to_string(func.get('args', [])),
         ': {}'.format(type_to_str(typ)) if typ != 'void' else '',
-    ))
-    for instr_or_label in func['instrs']:
-        if 'label' in instr_or_label:
-            print_label(instr_or_label)
+    )]
+    formatters = INSTR_FORMATTERS
+    for instr in func['instrs']:
+        if 'label' in instr:
+            lines.append('.{}:\n'.format(instr['label']))
         else:
-            print_instr(instr_or_label)
-    print('}')
+            fmt = formatters.get(instr['op'], _op_to_string)
+            lines.append('  ' + fmt(instr) + ';\n')
+    lines.append('}\n')
+    return ''.join(lines)
+
+
+def prog_to_text(prog):
+    """Render a program in the text format as a single string.
+    """
+    return ''.join(func_to_text(func) for func in prog['functions'])
+
+
+def print_func(func):
+    sys.stdout.write(func_to_text(func))
 
 
 def print_prog(prog):
+    sys.stdout.write(prog_to_text(prog))
+
+
+# Binary format. This is a compact encoding of the JSON representation
+# for piping programs between tools. After the `BINARY_MAGIC` header,
+# the file has a varint giving the byte length of a UTF-8 string table,
+# the table itself, and then a header and the functions, which are
+# streams of unsigned LEB128 varints. Each is prefixed with its length
+# in bytes, so tools can skip over functions without decoding them.
+#
+# - The header has the number of strings, followed by each string's
+#   length (in characters) in the table. Every opcode, variable, label,
+#   function name, and type name is replaced by its index in the table.
+#   Then come the top-level extra keys and the number of functions.
+# - Each function has its name, a flags word (`FUNC_*`), its arguments
+#   and type (if flagged), and its instructions.
+# - A label is a zero flags word followed by its name. An instruction
+#   is a nonzero flags word (`INSTR_*`) followed by each flagged field
+#   in order. Lists are a length followed by the items.
+# - Types are `2 * name` for primitive types and `2 * name + 1`
+#   followed by the parameter for parameterized types.
+# - Values have a tag (`VALUE_*`); integers are zigzag-encoded and
+#   floats are stored as their IEEE 754 bits.
+#
+# Anything else (unknown keys or unusual values) is stored as a JSON
+# string in the table, under the `*_EXTRA` flag, so the encoding is
+# lossless.
+
+BINARY_MAGIC = b'\x00BRIL\x02'
+
+FUNC_ARGS, FUNC_TYPE, FUNC_EXTRA = 1, 2, 4
+(INSTR_OP, INSTR_DEST, INSTR_TYPE, INSTR_ARGS, INSTR_FUNCS, INSTR_LABELS,
+ INSTR_VALUE, INSTR_EXTRA) = (1 << i for i in range(8))
+VALUE_FALSE, VALUE_TRUE, VALUE_INT, VALUE_FLOAT = range(4)
+
+_INSTR_FLAG_KEYS = (
+    (INSTR_OP, 'op'), (INSTR_DEST, 'dest'), (INSTR_TYPE, 'type'),
+    (INSTR_ARGS, 'args'), (INSTR_FUNCS, 'funcs'), (INSTR_LABELS, 'labels'),
+    (INSTR_VALUE, 'value'),
+)
+_DOUBLE = struct.Struct('<d')
+_UINT64 = struct.Struct('<Q')
+
+
+def _encoded_keys(flags):
+    """Get the instruction keys that are encoded under the given flags.
+    """
+    return {key for flag, key in _INSTR_FLAG_KEYS if flags & flag}
+
+
+def _is_type(typ):
+    while isinstance(typ, dict):
+        if len(typ) != 1:
+            return False
+        (key, typ), = typ.items()
+        if not isinstance(key, str):
+            return False
+    return isinstance(typ, str)
+
+
+def _is_names(names):
+    return isinstance(names, list) and \
+        all(isinstance(n, str) for n in names)
+
+
+def _write_varints(nums):
+    out = bytearray()
+    for n in nums:
+        while n >= 0x80:
+            out.append(n & 0x7f | 0x80)
+            n >>= 7
+        out.append(n)
+    return out
+
+
+# A multi-byte varint. Everything between these is single-byte varints.
+_LONG_VARINT_RE = re.compile(b'([\x80-\xff]+[\x00-\x7f])')
+
+
+def _read_varints(data):
+    out = []
+    for i, part in enumerate(_LONG_VARINT_RE.split(data)):
+        if i % 2:
+            n = 0
+            for shift, byte in enumerate(part):
+                n |= (byte & 0x7f) << (7 * shift)
+            out.append(n)
+        else:
+            out.extend(part)
+    return out
+
+
+def _read_varint(data, pos):
+    """Read one varint from `data` at `pos`. Return it and the position
+    just after it.
+    """
+    n = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+class BinEncoder:
+    """Encode programs in the binary format. An encoder can start from
+    the string table of a `BinSource`, in which case functions from that
+    source can be copied into the output without decoding them.
+    """
+    def __init__(self, source=None):
+        self.source = source
+        self.strings = []
+        self.indices = {}
+        if source:
+            self.strings.extend(source.strings)
+            for i, string in enumerate(source.strings):
+                self.indices.setdefault(string, i)
+
+    def intern(self, string):
+        try:
+            return self.indices[string]
+        except KeyError:
+            self.indices[string] = n = len(self.strings)
+            self.strings.append(string)
+            return n
+
+    def func(self, func):
+        """Encode a function (as JSON data), returning a list of varints.
+        """
+        out = []
+        emit = out.append
+        intern = self.intern
+
+        def emit_type(typ):
+            while isinstance(typ, dict):
+                (key, typ), = typ.items()
+                emit(intern(key) << 1 | 1)
+            emit(intern(typ) << 1)
+
+        def emit_names(names):
+            emit(len(names))
+            out.extend(map(intern, names))
+
+        known = {'name', 'instrs'}
+        flags = 0
+        args = func.get('args')
+        if isinstance(args, list) and all(
+            isinstance(a, dict) and a.keys() == {'name', 'type'} and
+            isinstance(a['name'], str) and _is_type(a['type'])
+            for a in args
+        ):
+            flags |= FUNC_ARGS
+            known.add('args')
+        if 'type' in func and _is_type(func['type']):
+            flags |= FUNC_TYPE
+            known.add('type')
+        if func.keys() - known:
+            flags |= FUNC_EXTRA
+
+        emit(intern(func['name']))
+        emit(flags)
+        if flags & FUNC_ARGS:
+            emit(len(args))
+            for arg in args:
+                emit(intern(arg['name']))
+                emit_type(arg['type'])
+        if flags & FUNC_TYPE:
+            emit_type(func['type'])
+        if flags & FUNC_EXTRA:
+            emit(self.extra(func, known))
+
+        instrs = func['instrs']
+        emit(len(instrs))
+        for instr in instrs:
+            if len(instr) == 1 and isinstance(instr.get('label'), str):
+                emit(0)
+                emit(intern(instr['label']))
+                continue
+
+            flags_pos = len(out)
+            emit(0)
+            flags = 0
+            if isinstance(instr.get('op'), str):
+                flags |= INSTR_OP
+                emit(intern(instr['op']))
+            if isinstance(instr.get('dest'), str):
+                flags |= INSTR_DEST
+                emit(intern(instr['dest']))
+            if 'type' in instr and _is_type(instr['type']):
+                flags |= INSTR_TYPE
+                emit_type(instr['type'])
+            if 'args' in instr and _is_names(instr['args']):
+                flags |= INSTR_ARGS
+                emit_names(instr['args'])
+            if 'funcs' in instr and _is_names(instr['funcs']):
+                flags |= INSTR_FUNCS
+                emit_names(instr['funcs'])
+            if 'labels' in instr and _is_names(instr['labels']):
+                flags |= INSTR_LABELS
+                emit_names(instr['labels'])
+            if 'value' in instr:
+                value = instr['value']
+                if value is True or value is False:
+                    flags |= INSTR_VALUE
+                    emit(VALUE_TRUE if value else VALUE_FALSE)
+                elif type(value) is int:
+                    flags |= INSTR_VALUE
+                    emit(VALUE_INT)
+                    emit(value << 1 if value >= 0 else -value << 1 | 1)
+                elif type(value) is float:
+                    flags |= INSTR_VALUE
+                    emit(VALUE_FLOAT)
+                    emit(_UINT64.unpack(_DOUBLE.pack(value))[0])
+
+            encoded = bin(flags).count('1') == len(instr)
+            if not encoded or not flags:
+                # Some keys have not been encoded. (Instructions with no
+                # keys also end up here, to keep them apart from labels.)
+                flags |= INSTR_EXTRA
+                emit(self.extra(instr, _encoded_keys(flags)))
+            out[flags_pos] = flags
+        return out
+
+    def extra(self, data, known):
+        """Intern the JSON of the keys in `data` that are not encoded.
+        """
+        return self.intern(json.dumps({k: v for k, v in data.items()
+                                       if k not in known}, sort_keys=True))
+
+    def encode(self, prog):
+        """Encode a program, returning a bytes object. Unloaded
+        `LazyFunc`s from this encoder's source are copied verbatim.
+        """
+        funcs = []
+        for func in prog['functions']:
+            if isinstance(func, LazyFunc) and not func.loaded and \
+                    func.source is self.source:
+                funcs.append(func.raw())
+            else:
+                if isinstance(func, LazyFunc):
+                    func = func.load()
+                body = _write_varints(self.func(func))
+                funcs.append(_write_varints([len(body)]))
+                funcs.append(body)
+
+        # Top-level keys other than `functions`, offset by one (zero means
+        # there are none).
+        extra = {k: v for k, v in prog.items() if k != 'functions'}
+        extra_index = self.intern(json.dumps(extra, sort_keys=True)) + 1 \
+            if extra else 0
+
+        strings = self.strings
+        table = ''.join(strings).encode('utf8')
+        header = _write_varints(
+            [len(strings)] + [len(s) for s in strings] +
+            [extra_index, len(prog['functions'])]
+        )
+        return b''.join([
+            BINARY_MAGIC,
+            _write_varints([len(table)]),
+            table,
+            _write_varints([len(header)]),
+            header,
+        ] + funcs)
+
+
+def encode_bin(prog):
+    """Encode a Bril program (as JSON data) in the binary format,
+    returning a bytes object.
+    """
+    return BinEncoder().encode(prog)
+
+
+class BinSource:
+    """A program in the binary format. This decodes the string table and
+    finds where each function starts and ends, but it only decodes
+    functions on request. `data` can be anything that supports slicing
+    into bytes, such as an `mmap`.
+    """
+    def __init__(self, data):
+        if data[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+            raise ValueError('not a binary Bril program')
+        self.data = data
+        table_len, pos = _read_varint(data, len(BINARY_MAGIC))
+        table = bytes(data[pos:pos + table_len]).decode('utf8')
+        header_len, pos = _read_varint(data, pos + table_len)
+        nums = iter(_read_varints(data[pos:pos + header_len]))
+        take = nums.__next__
+        pos += header_len
+
+        # Split the string table.
+        strings = self.strings = []
+        start = 0
+        for _ in range(take()):
+            end = start + take()
+            strings.append(table[start:end])
+            start = end
+
+        extra = take()
+        self.extra = json.loads(strings[extra - 1]) if extra else {}
+
+        # Each function's name, and the span of its bytes (including the
+        # length). The name is the first varint after the length.
+        self.funcs = []
+        for _ in range(take()):
+            length, start = _read_varint(data, pos)
+            name, _ = _read_varint(data, start)
+            self.funcs.append((strings[name], pos, start + length))
+            pos = start + length
+
+    def func(self, start, end):
+        """Decode the function whose bytes are at `data[start:end]`.
+        """
+        strings = self.strings
+        _, start = _read_varint(self.data, start)
+        nums = iter(_read_varints(self.data[start:end]))
+        take = nums.__next__
+        string = strings.__getitem__
+
+        def take_type():
+            n = take()
+            if n & 1:
+                return {strings[n >> 1]: take_type()}
+            else:
+                return strings[n >> 1]
+
+        def take_names():
+            return list(map(string, itertools.islice(nums, take())))
+
+        func = {'name': strings[take()]}
+        flags = take()
+        if flags & FUNC_ARGS:
+            func['args'] = [{'name': strings[take()], 'type': take_type()}
+                            for _ in range(take())]
+        if flags & FUNC_TYPE:
+            func['type'] = take_type()
+        if flags & FUNC_EXTRA:
+            func.update(json.loads(strings[take()]))
+
+        instrs = func['instrs'] = []
+        add = instrs.append
+        for _ in range(take()):
+            flags = take()
+            if not flags:
+                add({'label': strings[take()]})
+                continue
+
+            instr = {}
+            if flags & INSTR_OP:
+                instr['op'] = strings[take()]
+            if flags & INSTR_DEST:
+                instr['dest'] = strings[take()]
+            if flags & INSTR_TYPE:
+                instr['type'] = take_type()
+            if flags & INSTR_ARGS:
+                instr['args'] = take_names()
+            if flags & INSTR_FUNCS:
+                instr['funcs'] = take_names()
+            if flags & INSTR_LABELS:
+                instr['labels'] = take_names()
+            if flags & INSTR_VALUE:
+                tag = take()
+                if tag == VALUE_INT:
+                    n = take()
+                    instr['value'] = -(n >> 1) if n & 1 else n >> 1
+                elif tag == VALUE_FLOAT:
+                    instr['value'] = _DOUBLE.unpack(_UINT64.pack(take()))[0]
+                else:
+                    instr['value'] = tag == VALUE_TRUE
+            if flags & INSTR_EXTRA:
+                instr.update(json.loads(strings[take()]))
+            add(instr)
+        return func
+
+    def raw(self, start, end):
+        return bytes(self.data[start:end])
+
+
+def decode_bin(data):
+    """Decode a Bril program from the binary format, given as bytes.
+    """
+    source = BinSource(data)
+    prog = dict(source.extra)
+    prog['functions'] = [source.func(start, end)
+                         for _, start, end in source.funcs]
+    return prog
+
+
+# Lazy programs. Tools that only change a few functions can read a
+# program with `read_prog(fp, lazy=True)`, which indexes where each
+# function starts and ends in the input but only decodes a function when
+# something other than its name is accessed. `write_prog` copies the
+# functions that were never decoded straight from the input.
+
+_JSON_WS = re.compile(r'[ \t\n\r]*')
+
+
+class JSONSource:
+    """A program in the JSON format. This finds each function's name and
+    its span in `text`, keeping only the top-level keys other than
+    `functions` decoded.
+    """
+    def __init__(self, text):
+        self.text = text
+        decode = json.JSONDecoder().raw_decode
+        self.extra = {}
+        self.funcs = []
+
+        char, pos = self._next(0, '{')
+        char, pos = self._peek(pos)
+        if char == '}':
+            return
+        while True:
+            key, pos = decode(text, pos)
+            char, pos = self._next(pos, ':')
+            char, pos = self._peek(pos)
+            if key == 'functions' and char == '[':
+                char, pos = self._peek(pos + 1)
+                while char != ']':
+                    func, end = decode(text, pos)
+                    self.funcs.append((func['name'], pos, end))
+                    char, pos = self._next(end, ',]')
+                    if char == ',':
+                        char, pos = self._peek(pos)
+                    else:
+                        pos -= 1
+                pos += 1
+            else:
+                self.extra[key], pos = decode(text, pos)
+            char, pos = self._next(pos, ',}')
+            if char == '}':
+                break
+            char, pos = self._peek(pos)
+
+    def _peek(self, pos):
+        """Skip whitespace. Return the next character and its position.
+        """
+        pos = _JSON_WS.match(self.text, pos).end()
+        return self.text[pos:pos + 1], pos
+
+    def _next(self, pos, expected):
+        """Skip whitespace and consume one of the `expected` characters.
+        Return it and the position after it.
+        """
+        char, pos = self._peek(pos)
+        if not char or char not in expected:
+            raise ValueError('expected {} at position {}'.format(
+                ' or '.join(repr(c) for c in expected), pos,
+            ))
+        return char, pos + 1
+
+    def func(self, start, end):
+        return loads_json(self.text[start:end])
+
+    def raw(self, start, end):
+        return self.text[start:end].encode('utf8')
+
+
+class LazyFunc(MutableMapping):
+    """A function from a `BinSource` or `JSONSource`, which acts like
+    the function's dict but only decodes it when something other than
+    its name is accessed.
+    """
+    def __init__(self, source, name, start, end):
+        self.source = source
+        self.name = name
+        self.span = (start, end)
+        self.func = None
+
+    @property
+    def loaded(self):
+        return self.func is not None
+
+    def load(self):
+        """Decode the function (if necessary) and return its dict.
+        """
+        if self.func is None:
+            self.func = self.source.func(*self.span)
+        return self.func
+
+    def raw(self):
+        """Get the function's encoded bytes from the input.
+        """
+        return self.source.raw(*self.span)
+
+    def __getitem__(self, key):
+        if key == 'name' and self.func is None:
+            return self.name
+        return self.load()[key]
+
+    def __setitem__(self, key, value):
+        self.load()[key] = value
+
+    def __delitem__(self, key):
+        del self.load()[key]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+    def __repr__(self):
+        state = 'loaded' if self.loaded else 'not loaded'
+        return '<LazyFunc {} ({})>'.format(self.name, state)
+
+
+def _map_input(fp):
+    """Get the contents of the binary file `fp`, memory-mapping it if it
+    is a regular file.
+    """
+    try:
+        fd = fp.fileno()
+        st = os.fstat(fd)
+        if stat.S_ISREG(st.st_mode) and st.st_size:
+            return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError, io.UnsupportedOperation):
+        pass  # Not a real file.
+    return fp.read()
+
+
+def _unloaded_source(prog, cls):
+    """Find the source of an undecoded function in `prog` that comes
+    from a `cls` source, or None if there are none.
+    """
+    for func in prog['functions']:
+        if isinstance(func, LazyFunc) and not func.loaded and \
+                isinstance(func.source, cls):
+            return func.source
+    return None
+
+
+def _loaded(prog):
+    """Get a copy of `prog` with plain dicts for all its functions.
+    """
+    prog = dict(prog)
+    prog['functions'] = [f.load() if isinstance(f, LazyFunc) else f
+                         for f in prog['functions']]
+    return prog
+
+
+def _dumps_json_lazy(prog, source):
+    """Encode a program as compact JSON, copying the functions from
+    `source` that were never decoded.
+    """
+    parts = []
     for func in prog['functions']:
-        print_func(func)
+        if isinstance(func, LazyFunc) and not func.loaded and \
+                func.source is source:
+            parts.append(func.raw())
+        else:
+            if isinstance(func, LazyFunc):
+                func = func.load()
+            parts.append(dumps_json(func)[:-1])
+    extra = {k: v for k, v in prog.items() if k != 'functions'}
+    out = [b'{"functions":[', b','.join(parts), b']']
+    if extra:
+        # Splice in the members without their braces.
+        out.extend([b',', dumps_json(extra)[1:-2]])
+    out.append(b'}\n')
+    return b''.join(out)
+
 
+# Program I/O for tools. Passes should read and write programs with
+# `read_prog` and `write_prog`, which handle both formats and pick a
+# cheap encoding when the output is going to another program.
+
+try:
+    import orjson
+except ImportError:  # Fall back to the standard library.
+    orjson = None
+
+# Output formats: compact JSON, indented and sorted JSON, and binary.
+OUTPUT_FORMATS = ('json', 'pretty', 'bin')
+
+
+def loads_json(data):
+    """Decode JSON from bytes, using orjson if it is available. (orjson
+    reads integers wider than 64 bits as floats, but Bril integers are
+    64 bits anyway.)
+    """
+    if orjson:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass  # Maybe it uses an extension, like `Infinity`.
+    return json.loads(data)
+
+
+def dumps_json(prog, pretty=False):
+    """Encode JSON as bytes. Pretty output is indented with sorted keys
+    (and always comes from the standard library, so it is stable);
+    otherwise, the output is compact and uses orjson if available.
+    """
+    if pretty:
+        text = json.dumps(prog, indent=2, sort_keys=True) + '\n'
+    else:
+        if orjson:
+            try:
+                return orjson.dumps(prog, option=orjson.OPT_APPEND_NEWLINE)
+            except TypeError:
+                pass  # Probably an integer that is too big.
+        text = json.dumps(prog, separators=(',', ':')) + '\n'
+    return text.encode('utf8')
+
+
+def read_prog(fp, lazy=False):
+    """Read a program from the file `fp` in either the JSON or the
+    binary format. Return the program and a flag indicating whether it
+    was binary. With `lazy`, the functions in the program are
+    `LazyFunc`s, which are decoded only when they are used.
+    """
+    if hasattr(fp, 'buffer'):
+        data = _map_input(fp.buffer) if lazy else fp.buffer.read()
+        binary = data[:len(BINARY_MAGIC)] == BINARY_MAGIC
+        if not lazy:
+            return (decode_bin(data) if binary else loads_json(data)), binary
+
+        source = BinSource(data) if binary else JSONSource(str(data, 'utf8'))
+        prog = dict(source.extra)
+        prog['functions'] = [LazyFunc(source, *func)
+                             for func in source.funcs]
+        return prog, binary
+    else:
+        return json.load(fp), False
+
+
+def output_format(fp, binary=False):
+    """Choose a format for writing a program to `fp`. The `BRIL_OUTPUT`
+    environment variable, if set, picks one of the `OUTPUT_FORMATS`.
+    Otherwise, we use binary if `binary` is set, pretty JSON for a
+    terminal, and compact JSON for anything else (like a pipe).
+    """
+    fmt = os.environ.get('BRIL_OUTPUT')
+    if fmt:
+        if fmt not in OUTPUT_FORMATS:
+            raise ValueError('unknown BRIL_OUTPUT {}; choose from {}'.format(
+                fmt, ', '.join(OUTPUT_FORMATS),
+            ))
+        return fmt
+    elif binary:
+        return 'bin'
+    elif fp.isatty():
+        return 'pretty'
+    else:
+        return 'json'
+
+
+def write_prog(prog, fp, binary=False):
+    """Write a program to the file `fp` in the format chosen by
+    `output_format`. Tools should pass the flag from `read_prog` as
+    `binary` to write the same format they read.
+    """
+    fmt = output_format(fp, binary)
+    if fmt == 'bin':
+        data = BinEncoder(_unloaded_source(prog, BinSource)).encode(prog)
+    else:
+        source = fmt == 'json' and _unloaded_source(prog, JSONSource)
+        if source:
+            data = _dumps_json_lazy(prog, source)
+        else:
+            data = dumps_json(_loaded(prog), fmt == 'pretty')
+    if hasattr(fp, 'buffer'):
+        # Write the bytes directly, bypassing text encoding.
+        fp.flush()
+        fp.buffer.write(data)
+        fp.buffer.flush()
+    elif fmt == 'bin':
+        raise ValueError('cannot write binary Bril to a text stream')
+    else:
+        fp.write(data.decode('utf8'))
+
+
+def func_names(argv):
+    """Get the function names given with `--func=<name>` flags, which
+    restrict a pass to some functions. Return None if there are none.
+    """
+    names = {arg[len('--func='):] for arg in argv
+             if arg.startswith('--func=')}
+    return names or None
+
+
+def select_funcs(prog, names=None):
+    """Get the functions in `prog` whose names are in `names` (or all of
+    them if `names` is None). Only the names of the functions are
+    accessed, so other functions in a lazy program stay undecoded.
+    """
+    return [func for func in prog['functions']
+            if names is None or func['name'] in names]
+
+
+def jobs_arg(argv):
+    """Get the number of worker processes from a `--jobs N` (or
+    `--jobs=N`) flag, defaulting to 1.
+    """
+    for i, arg in enumerate(argv):
+        if arg.startswith('--jobs='):
+            return int(arg[len('--jobs='):])
+        elif arg == '--jobs' and i + 1 < len(argv):
+            return int(argv[i + 1])
+    return 1
+
+
+def _map_shard(func_pass, data):
+    """Apply `func_pass` to each function in a binary-encoded shard of
+    functions, and encode the results the same way.
+    """
+    funcs = decode_bin(data)['functions']
+    return encode_bin({'functions': [func_pass(f) for f in funcs]})
+
+
+def map_funcs(func_pass, funcs, jobs=1):
+    """Apply `func_pass`, which takes a function dict and returns the
+    transformed function, to each of `funcs`. Return the results, in
+    order.
+
+    With more than one job, the functions are split into contiguous
+    shards that a pool of worker processes transforms. Shards travel to
+    and from the workers in the binary format, which is much smaller and
+    cheaper to build than pickled dicts (and undecoded `LazyFunc`s from
+    binary input are copied over without decoding them). `func_pass`
+    must be picklable: a module-level function, or a `functools.partial`
+    of one.
+    """
+    funcs = list(funcs)
+    if jobs <= 1 or len(funcs) < 2:
+        return [func_pass(func) for func in funcs]
+
+    # A few shards per worker, to even out the load.
+    size = -(-len(funcs) // min(len(funcs), jobs * 4))
+    shards = []
+    for start in range(0, len(funcs), size):
+        shard = {'functions': funcs[start:start + size]}
+        shards.append(BinEncoder(_unloaded_source(shard, BinSource))
+                      .encode(shard))
+
+    out = []
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        for data in pool.map(_map_shard, itertools.repeat(func_pass),
+                             shards):
+            out.extend(decode_bin(data)['functions'])
+    return out
+
+
+def transform_funcs(bril, func_pass, names=None, jobs=1):
+    """Replace each function in the program `bril` (or just the ones in
+    `names`) with the result of `func_pass`, as in `map_funcs`.
+    """
+    funcs = bril['functions']
+    indices = [i for i, func in enumerate(funcs)
+               if names is None or func['name'] in names]
+    results = map_funcs(func_pass, [funcs[i] for i in indices], jobs)
+    for i, func in zip(indices, results):
+        funcs[i] = func
+    return bril
+
+
+# Command-line entry points. With `--stream`, both commands work one
+# function at a time (and `bril2json` always uses the hand-written
+# parser).
+
+def parser_engine(argv):
+    """Choose the parser engine from a `--parser=<engine>` flag or the
+    `BRIL_PARSER` environment variable, defaulting to LALR.
+    """
+    engine = os.environ.get('BRIL_PARSER', 'lalr')
+    for arg in argv:
+        if arg.startswith('--parser='):
+            engine = arg[len('--parser='):]
+    if engine not in ENGINES:
+        sys.exit('unknown parser engine {}; choose from {}'.format(
+            engine, ', '.join(ENGINES),
+        ))
+    return engine
 
-# Command-line entry points.
 
 def bril2json():
-    print(parse_bril(sys.stdin.read()))
+    if '--stream' in sys.argv[1:]:
+        dump_funcs(Parser(sys.stdin).funcs(), sys.stdout)
+    else:
+        print(parse_bril(sys.stdin.read(), parser_engine(sys.argv[1:])))
 
 
 def bril2txt():
-    print_prog(json.load(sys.stdin))
+    if '--stream' in sys.argv[1:]:
+        for func in load_funcs(sys.stdin):
+            print_func(func)
+    else:
+        print_prog(read_prog(sys.stdin)[0])
+
+
+def bril2bin():
+    sys.stdout.buffer.write(encode_bin(read_prog(sys.stdin)[0]))
+
+
+def bin2bril():
+    write_prog(read_prog(sys.stdin)[0], sys.stdout)
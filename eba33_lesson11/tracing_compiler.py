@@ -4,6 +4,8 @@ import re
 import hashlib
 import os
 
+import briltxt
+
 SPECULATIVE_LABEL = "SPECULATIVE"
 
 
@@ -126,7 +128,9 @@ def fix_fallthrough(fn, label):
                 fn['instrs'].insert(i, {'op': 'jmp', 'labels': [label]})
 
 if __name__ == '__main__':
-    prog = json.load(sys.stdin)
+    # Only the function with the hot path is rewritten, so the others
+    # are passed through without decoding them.
+    prog, binary = briltxt.read_prog(sys.stdin, lazy=True)
     with open('/tmp/briltrace', 'r') as briltrace:
         trace = process_trace(briltrace.readlines())
     path = extract_hot_trace(trace)
@@ -137,4 +141,4 @@ if __name__ == '__main__':
         fn['instrs'] = [rename_instr(i, path[0][0], SPECULATIVE_LABEL) for i in fn['instrs']]
         fn['instrs'].append({'op': 'ret'})
         fn['instrs'].extend(block)
-    print(json.dumps(prog, indent=2, sort_keys=True))
+    briltxt.write_prog(prog, sys.stdout, binary)
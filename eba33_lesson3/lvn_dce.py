@@ -1,6 +1,7 @@
-import json
 import sys
 
+import briltxt
+
 TERMINATORS = ['jmp', 'br', 'ret']
 COMMUNATIVE = ['add', 'mul', 'eq', 'and', 'or']
 
@@ -98,11 +99,11 @@ def lvn(block):
             
 
 if __name__ == '__main__':
-    prog = json.load(sys.stdin)
+    prog, binary = briltxt.read_prog(sys.stdin)
     for func in prog['functions']:
         new_instrs = []
         for block in form_blocks(func['instrs']):
             new_instrs.extend(trivial_dce(lvn(block)))
         func['instrs'] = new_instrs
 
-    print(json.dumps(prog, indent=2, sort_keys=True))
+    briltxt.write_prog(prog, sys.stdout, binary)
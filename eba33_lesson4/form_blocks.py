@@ -1,7 +1,6 @@
 """Create and print out the basic blocks in a Bril function.
 """
 
-import json
 import sys
 
 # Instructions that terminate a basic block.
@@ -53,19 +52,24 @@ def print_blocks(bril):
     import briltxt
 
     func = bril['functions'][0]  # We only process one function.
+    lines = []
     for block in form_blocks(func['instrs']):
         # Mark the block.
         leader = block[0]
         if 'label' in leader:
-            print('block "{}":'.format(leader['label']))
+            lines.append('block "{}":\n'.format(leader['label']))
             block = block[1:]  # Hide the label, for concision.
         else:
-            print('anonymous block:')
+            lines.append('anonymous block:\n')
 
         # Print the instructions.
         for instr in block:
-            print('  {}'.format(briltxt.instr_to_string(instr)))
+            lines.append('  ' + briltxt.instr_to_string(instr) + '\n')
+
+    # Write everything at once.
+    sys.stdout.write(''.join(lines))
 
 
 if __name__ == '__main__':
-    print_blocks(json.load(sys.stdin))
+    import briltxt
+    print_blocks(briltxt.read_prog(sys.stdin)[0])
@@ -2,6 +2,8 @@ import json
 import sys
 from functools import reduce
 
+import briltxt
+
 from form_blocks import form_blocks
 import cfg
 
@@ -172,7 +174,7 @@ def interval_analysis(instrs):
     return out
 
 if __name__ == '__main__':
-    prog = json.load(sys.stdin)
+    prog, _ = briltxt.read_prog(sys.stdin)
     result = {}
     for func in prog['functions']:
         result[func["name"]] = stringify_interval_output(
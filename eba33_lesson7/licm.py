@@ -1,8 +1,7 @@
-import json
 import sys
 
-from form_blocks import form_blocks
-import cfg
+import briltxt
+
 import ssa
 
 def find_backedges(fn, succs, doms):
@@ -167,10 +166,8 @@ def loop2string(loop):
 
 def licm(fn):
     fn = ssa.to_ssa(fn)
-    blockmap = cfg.block_map(form_blocks(fn['instrs']))
-    cfg.add_terminators(blockmap)
-    preds, succs = cfg.edges(blockmap)
-    doms = ssa.find_dominators(fn)
+    blockmap, preds, succs = graph = ssa.fn_cfg(fn)
+    doms = ssa.find_dominators(fn, graph)
     preheader_num = 0
     loops_seen = set()
 
@@ -187,12 +184,12 @@ def licm(fn):
     fn['instrs'] = blockmap2instrs(blockmap)
     return ssa.from_ssa(fn) 
     
-def licm_program(prog):
+def licm_program(prog, jobs=1):
     new_prog = prog.copy()
-    new_prog['functions'] = [licm(fn) for fn in prog['functions']]
+    new_prog['functions'] = briltxt.map_funcs(licm, prog['functions'], jobs)
     return new_prog
 
 if __name__ == '__main__':
-    prog = json.load(sys.stdin)
-    new_prog = licm_program(prog)
-    print(json.dumps(new_prog, indent=2, sort_keys=True))
+    prog, binary = briltxt.read_prog(sys.stdin)
+    new_prog = licm_program(prog, briltxt.jobs_arg(sys.argv[1:]))
+    briltxt.write_prog(new_prog, sys.stdout, binary)
@@ -6,22 +6,38 @@ from form_blocks import form_blocks
 import cfg
 from functools import reduce
 
+import briltxt
+
 SSA_DEFAULT = 'SSA_DEFAULT'
 SSA_ENTRY = 'SSA_ENTRY'
 
 def postorder_sort(block, succs, visited):
+    """ Every block that is not yet visited, after `block` and then in
+    the order of `succs`, listed in reverse. (Only the order of the
+    result matters to `find_dominators`, so this loops rather than
+    recursing one level per block, which overflowed the stack on long
+    functions.) """
     visited.add(block)
-    l = []
+    l = [block]
     for s in succs:
         if s not in visited:
-            l.extend(postorder_sort(s, succs, visited))
-    l.append(block)
+            visited.add(s)
+            l.append(s)
+    l.reverse()
     return l
 
-def find_dominators(fn):
+def fn_cfg(fn):
+    """Build the block map (with terminators) and the predecessor and
+    successor maps for a function, so the functions below can share them
+    instead of each rebuilding the CFG.
+    """
     blockmap = cfg.block_map(form_blocks(fn['instrs']))
     cfg.add_terminators(blockmap)
     preds, succs = cfg.edges(blockmap)
+    return blockmap, preds, succs
+
+def find_dominators(fn, graph=None):
+    blockmap, preds, succs = graph or fn_cfg(fn)
 
     entry = list(blockmap.keys())[0]
     sorted_blocks = postorder_sort(entry, succs, set())
@@ -41,9 +57,8 @@ def find_dominators(fn):
             dom = new_dom.copy()
 
 def dom_tree(fn):
-    dom = find_dominators(fn)
-    blockmap = cfg.block_map(form_blocks(fn['instrs']))
-    cfg.add_terminators(blockmap)
+    blockmap, preds, succs = graph = fn_cfg(fn)
+    dom = find_dominators(fn, graph)
 
     def subtree(root):
         descendants = [b for b in dom.keys() if b!=root and root in dom[b]]
@@ -64,10 +79,9 @@ def dom_tree(fn):
     root = list(blockmap.keys())[0]
     return {root: subtree(root)}
 
-def dom_tree_flat(fn):
-    dom = find_dominators(fn)
-    blockmap = cfg.block_map(form_blocks(fn['instrs']))
-    cfg.add_terminators(blockmap)
+def dom_tree_flat(fn, dom=None, graph=None):
+    blockmap, preds, succs = graph = graph or fn_cfg(fn)
+    dom = dom or find_dominators(fn, graph)
 
     domtree = {}
     
@@ -86,11 +100,9 @@ def dom_tree_flat(fn):
     return domtree
 
 # return blocks not strictly dominated by a block, but predecessor is dominated
-def dom_frontier(fn):
-    dom = find_dominators(fn)
-    blockmap = cfg.block_map(form_blocks(fn['instrs']))
-    cfg.add_terminators(blockmap)
-    preds, succs = cfg.edges(blockmap)
+def dom_frontier(fn, dom=None, graph=None):
+    blockmap, preds, succs = graph = graph or fn_cfg(fn)
+    dom = dom or find_dominators(fn, graph)
     
     frontier = {}
     for block in dom.keys():
@@ -146,13 +158,12 @@ def add_labels(blockmap):
         blockmap[blockname] = [{'label': blockname}] + instr
 
 def to_ssa(fn):
-    dom = find_dominators(fn)
-    blockmap = cfg.block_map(form_blocks(fn['instrs']))
-    cfg.add_terminators(blockmap)
+    # Build the CFG and dominators once and share them.
+    blockmap, preds, succs = graph = fn_cfg(fn)
+    dom = find_dominators(fn, graph)
+    DF = dom_frontier(fn, dom, graph)
+    domtree = dom_tree_flat(fn, dom, graph)
     add_labels(blockmap)
-    preds, succs = cfg.edges(blockmap)
-    DF = dom_frontier(fn)
-    domtree = dom_tree_flat(fn)
     entry = list(blockmap.keys())[0]
     
     # compute mapping from vars to basic blocks defining them
@@ -190,7 +201,7 @@ def to_ssa(fn):
         freshnum[oldname] += 1
         stack[oldname].append(newname)
         return newname
-    def rename(block):
+    def rename_block(block):
         stacksize = {v: 0 for v in vars_and_args} # how many times we pushed to each stack
         for instr in blockmap[block]:
             if instr.get('op','')!='phi' and 'args' in instr:
@@ -204,11 +215,21 @@ def to_ssa(fn):
                 if stack[oldname]:
                     p['args'].append(stack[oldname][-1])
                     p['labels'].append(block)
-        for b in domtree[block]:
-            rename(b) 
-        for v, size in stacksize.items():
-            for _ in range(size):
-                stack[v].pop()
+        return stacksize
+    def rename(root):
+        # walk the dominator tree with an explicit stack of (children
+        # left to visit, pushes to undo) so deep trees don't overflow
+        work = [(iter(domtree[root]), rename_block(root))]
+        while work:
+            children, stacksize = work[-1]
+            child = next(children, None)
+            if child is not None:
+                work.append((iter(domtree[child]), rename_block(child)))
+                continue
+            work.pop()
+            for v, size in stacksize.items():
+                for _ in range(size):
+                    stack[v].pop()
     if 'args' in fn:
         fn['args'] = [{'name': rename_var(a['name']), 'type': a['type']} for a in fn['args']]
     rename(list(blockmap.keys())[0])
@@ -266,18 +287,18 @@ def from_ssa(fn):
     new_fn['instrs'] =  [i for block in blockmap.values() for i in block if i.get('op', '')!='phi']
     return new_fn
 
-def to_ssa_program(prog):
+def to_ssa_program(prog, binary=False):
     new_prog = prog.copy()
     new_prog['functions'] = [to_ssa(fn) for fn in prog['functions']]
-    print(json.dumps(new_prog, indent=2, sort_keys=True))
+    briltxt.write_prog(new_prog, sys.stdout, binary)
 
-def from_ssa_program(prog):
+def from_ssa_program(prog, binary=False):
     new_prog = prog.copy()
     new_prog['functions'] = [from_ssa(fn) for fn in prog['functions']]
-    print(json.dumps(new_prog, indent=2, sort_keys=True))
+    briltxt.write_prog(new_prog, sys.stdout, binary)
 
 if __name__ == '__main__':
-    prog = json.load(sys.stdin)
+    prog, binary = briltxt.read_prog(sys.stdin)
     if sys.argv[1] == '--doms':
         find_dominators_program(prog)
     elif sys.argv[1] == '--domtree':
@@ -285,9 +306,9 @@ if __name__ == '__main__':
     elif sys.argv[1] == '--domfrontier':
         dom_frontier_program(prog)
     elif sys.argv[1] == '--tossa':
-        to_ssa_program(prog)
+        to_ssa_program(prog, binary)
     elif sys.argv[1] == '--fromssa':
-        from_ssa_program(prog)
+        from_ssa_program(prog, binary)
     else:
         print('Invalid argument')
 
@@ -0,0 +1,151 @@
+"""Aggressive dead code elimination on SSA form.
+
+Unlike `tdce.py` and `dce.py`, which assume every instruction is needed
+until its result is shown to be unused, this pass assumes nothing is
+needed until shown otherwise. It marks the instructions with effects
+(prints, returns, stores, calls, and so on) and then, working backward,
+the definitions of their arguments and the branches they are control
+dependent on. Everything left unmarked is deleted: computations, whole
+branches, and loops whose results are never used. An unmarked branch
+becomes a jump to its nearest post-dominator that still does something.
+
+Functions are converted to SSA form first (unless they already are),
+and stay in SSA form:
+
+    bril2json < prog.bril | python adce.py | python from_ssa.py
+"""
+
+import sys
+from collections import OrderedDict
+
+import briltxt
+
+from analysis import AnalysisManager
+from cfg import reassemble, successors
+from is_ssa import is_ssa
+from to_ssa import func_to_ssa
+
+# Instructions without results that only matter for where control goes.
+CONTROL_OPS = frozenset(('br', 'jmp', 'nop'))
+
+
+def mark(graph, ipdom, cdeps):
+    """Find the needed instructions in an SSA-form function, given its
+    `cfg.CFG`, immediate post-dominators, and control dependences.
+    Produce the set of the `id`s of the needed instructions and a list
+    marking the block ids that contain any of them.
+    """
+    defs = {}
+    for node, block in enumerate(graph.blocks):
+        for instr in block:
+            if 'dest' in instr:
+                defs[instr['dest']] = (node, instr)
+
+    marked = set()
+    useful = bytearray(len(graph))
+    work = []
+
+    def need(node, instr):
+        if id(instr) not in marked:
+            marked.add(id(instr))
+            work.append((node, instr))
+
+    for node, block in enumerate(graph.blocks):
+        for instr in block:
+            op = instr.get('op')
+            if op == 'call' or 'dest' not in instr and op not in CONTROL_OPS:
+                need(node, instr)
+        # Removing the way into an infinite loop would make the function
+        # return where it used to hang, so keep those branches.
+        if ipdom[node] == -1 or any(ipdom[s] == -1 for s in graph.succs(node)):
+            need(node, block[-1])
+
+    while work:
+        node, instr = work.pop()
+        if not useful[node]:
+            # The block runs only when the branches it depends on say
+            # so.
+            useful[node] = 1
+            for dep in cdeps[node]:
+                need(dep, graph.blocks[dep][-1])
+        for arg in instr.get('args', ()):
+            if arg in defs:
+                need(*defs[arg])
+        if instr.get('op') == 'phi':
+            # The value depends on which predecessor we came from.
+            for label in instr['labels']:
+                pred = graph.index[label]
+                need(pred, graph.blocks[pred][-1])
+
+    return marked, useful
+
+
+def func_adce(func, am=None):
+    """Delete the instructions in a function dict that are not needed,
+    converting it to SSA form first if it is not already. Get the CFG
+    and post-dominators from the `AnalysisManager` `am`, if there is
+    one.
+    """
+    am = am or AnalysisManager()
+    if not is_ssa({'functions': [func]}):
+        func_to_ssa(func, am)
+    graph = am.get(func, 'cfg')
+    ipdom = am.get(func, 'ipdom')
+    marked, useful = mark(graph, ipdom, am.get(func, 'control_deps'))
+
+    # Sweep. Every path from an unneeded branch reaches its nearest
+    # useful post-dominator without doing anything on the way, so we
+    # can jump straight there.
+    for node, block in enumerate(graph.blocks):
+        term = block[-1]
+        if term['op'] == 'br' and id(term) not in marked:
+            target = ipdom[node]
+            while not useful[target]:
+                target = ipdom[target]
+            term = {'op': 'jmp', 'labels': [graph.names[target]]}
+        block[:] = [instr for instr in block[:-1] if id(instr) in marked]
+        block.append(term)
+
+    # Drop the blocks we can no longer reach, and the phi-node arguments
+    # from the edges that are gone.
+    reached = {graph.names[0]}
+    work = [graph.names[0]]
+    preds = {}
+    blocks = graph.block_map()
+    while work:
+        name = work.pop()
+        for succ in successors(blocks[name][-1]):
+            preds.setdefault(succ, set()).add(name)
+            if succ not in reached:
+                reached.add(succ)
+                work.append(succ)
+    blocks = OrderedDict((name, block) for name, block in blocks.items()
+                         if name in reached)
+    for name, block in blocks.items():
+        for i, instr in enumerate(block):
+            if instr.get('op') == 'phi':
+                pairs = [(label, arg)
+                         for label, arg in zip(instr['labels'], instr['args'])
+                         if label in preds.get(name, ())]
+                instr['labels'] = [label for label, _ in pairs]
+                instr['args'] = [arg for _, arg in pairs]
+                if len(pairs) == 1:
+                    block[i] = {'op': 'id', 'dest': instr['dest'],
+                                'type': instr['type'], 'args': instr['args']}
+
+    func['instrs'] = reassemble(blocks)
+    am.invalidate(func['name'])
+    return func
+
+
+def adce(bril, names=None, jobs=1):
+    return briltxt.transform_funcs(bril, func_adce, names, jobs)
+
+
+if __name__ == '__main__':
+    bril, binary = briltxt.read_prog(sys.stdin, lazy=True)
+    args = sys.argv[1:]
+    briltxt.write_prog(
+        adce(bril, briltxt.func_names(args), briltxt.jobs_arg(args)),
+        sys.stdout, binary,
+    )
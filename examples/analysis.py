@@ -0,0 +1,168 @@
+"""Memoized per-function analyses for running several passes in a row.
+
+An `AnalysisManager` computes analyses (the CFG, dominators, and so on)
+on demand and remembers them for each function. After a pass changes a
+function, call `invalidate` with the analyses the pass preserves, and
+everything else is thrown away.
+"""
+from form_blocks import form_blocks
+import cfg
+import df
+from graphs import loop_forest
+from dom import (DomTree, get_idom, idom_fronts, dom_sets, reverse_cfg,
+                 get_ipdom, control_deps)
+
+
+def _cfg(am, func):
+    """The CFG, with a unique entry block and terminators on every block
+    (the way `to_ssa` and `from_ssa` prepare their blocks).
+    """
+    blocks = cfg.block_map(form_blocks(func['instrs']))
+    cfg.add_entry(blocks)
+    cfg.add_terminators(blocks)
+    return cfg.CFG.from_block_map(blocks)
+
+
+def _idom(am, func):
+    """The immediate dominators, as a list indexed by block id (see
+    `dom.get_idom`).
+    """
+    return get_idom(am.get(func, 'cfg'))
+
+
+def _dominance(am, func):
+    """The dominator tree numbered for constant-time dominance queries
+    (see `dom.DomTree`).
+    """
+    return DomTree(am.get(func, 'idom'))
+
+
+def _dom(am, func):
+    return dom_sets(am.get(func, 'cfg').names, am.get(func, 'idom'))
+
+
+def _front(am, func):
+    graph = am.get(func, 'cfg')
+    fronts = idom_fronts(graph, am.get(func, 'idom'))
+    return {name: [graph.names[b] for b in front]
+            for name, front in zip(graph.names, fronts)}
+
+
+def _dom_tree(am, func):
+    names = am.get(func, 'cfg').names
+    children = am.get(func, 'dominance').children
+    return {name: {names[c] for c in kids}
+            for name, kids in zip(names, children)}
+
+
+def _live(am, func):
+    """Live variables at the start and end of every block, as bit masks:
+    the `ir.Names` table numbering the variables and a pair of dicts
+    (see `df.df_bits`).
+    """
+    return df.df_bits(am.get(func, 'cfg'), df.BIT_ANALYSES['live'])
+
+
+def _live_instrs(am, func):
+    """Live variables at each instruction, as a `df.InstrFacts` of bit
+    masks that replays blocks from the cached `live` result when they
+    are queried.
+    """
+    vars, in_, out = am.get(func, 'live')
+    step = df.bit_step(df.BIT_ANALYSES['live'], vars)
+    return df.InstrFacts(am.get(func, 'cfg'), False, step, in_, out, vars)
+
+
+def _loop_forest(am, func):
+    """The loop-nesting forest: a list of `graphs.Loop`s, inner loops
+    first, and a list mapping each block id to the index of its
+    innermost loop (see `graphs.loop_forest`).
+    """
+    return loop_forest(am.get(func, 'cfg'), am.get(func, 'dominance'))
+
+
+def _loops(am, func):
+    """The natural loops: a map from each loop header to the set of
+    blocks in its loop. (Loops with the same header are merged.)
+    """
+    names = am.get(func, 'cfg').names
+    loops, _ = am.get(func, 'loop_forest')
+    return {names[loop.header]: {names[b] for b in loop.blocks}
+            for loop in loops}
+
+
+def _reverse_cfg(am, func):
+    """The CFG with its edges reversed and a virtual exit added (see
+    `dom.reverse_cfg`), for post-dominance.
+    """
+    return reverse_cfg(am.get(func, 'cfg'))
+
+
+def _ipdom(am, func):
+    """The immediate post-dominators, as a list indexed by block id with
+    the virtual exit last (see `dom.get_ipdom`).
+    """
+    return get_ipdom(am.get(func, 'reverse_cfg'))
+
+
+def _control_deps(am, func):
+    return control_deps(am.get(func, 'reverse_cfg'), am.get(func, 'ipdom'))
+
+
+# Each analysis takes the manager (to get the analyses it builds on) and
+# the function dict, and produces the result.
+ANALYSES = {
+    'cfg': _cfg,
+    'idom': _idom,
+    'dominance': _dominance,
+    'dom': _dom,
+    'front': _front,
+    'dom_tree': _dom_tree,
+    'live': _live,
+    'live_instrs': _live_instrs,
+    'loop_forest': _loop_forest,
+    'loops': _loops,
+    'reverse_cfg': _reverse_cfg,
+    'ipdom': _ipdom,
+    'control_deps': _control_deps,
+}
+
+# The analyses that only depend on the shape of the CFG, which passes
+# that never add, remove, or retarget blocks preserve.
+CFG_SHAPE = frozenset(('idom', 'dominance', 'dom', 'front', 'dom_tree',
+                       'loop_forest', 'loops', 'reverse_cfg', 'ipdom',
+                       'control_deps'))
+
+
+class AnalysisManager:
+    """Compute and cache analyses of functions, keyed by function name.
+    """
+    def __init__(self):
+        self._cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, func, name):
+        """Get analysis `name` for the function dict `func`, computing it
+        if it is not cached.
+        """
+        results = self._cache.setdefault(func['name'], {})
+        if name in results:
+            self.hits += 1
+        else:
+            self.misses += 1
+            results[name] = ANALYSES[name](self, func)
+        return results[name]
+
+    def invalidate(self, name, preserved=()):
+        """Forget the analyses of the function called `name`, except the
+        ones in `preserved`.
+        """
+        results = self._cache.get(name)
+        if results:
+            for analysis in list(results):
+                if analysis not in preserved:
+                    del results[analysis]
+
+    def clear(self):
+        self._cache.clear()
@@ -1,34 +1,46 @@
+from array import array
 from collections import OrderedDict
-from util import fresh, flatten
+from util import fresh, fresh_names
 from form_blocks import TERMINATORS
+import graphs
 
 
-def block_map(blocks):
+def name_blocks(blocks):
     """Given a sequence of basic blocks, which are lists of instructions,
-    produce a `OrderedDict` mapping names to blocks.
+    produce two parallel lists: the blocks' names and the blocks
+    themselves, with their labels removed.
 
     The name of the block comes from the label it starts with, if any.
     Anonymous blocks, which don't start with a label, get an
-    automatically generated name. Blocks in the mapping have their
-    labels removed.
+    automatically generated name that does not clash with any label.
     """
-    by_name = OrderedDict()
+    blocks = list(blocks)
+    labels = {block[0]['label'] for block in blocks if 'label' in block[0]}
+    anon_names = fresh_names('b', labels)
 
+    names = []
+    out = []
     for block in blocks:
-        # Generate a name for the block.
         if 'label' in block[0]:
             # The block has a label. Remove the label but use it for the
             # block's name.
-            name = block[0]['label']
-            block = block[1:]
+            names.append(block[0]['label'])
+            out.append(block[1:])
         else:
             # Make up a new name for this anonymous block.
-            name = fresh('b', by_name)
+            names.append(next(anon_names))
+            out.append(block)
+    return names, out
+
 
-        # Add the block to the mapping.
-        by_name[name] = block
+def block_map(blocks):
+    """Given a sequence of basic blocks, which are lists of instructions,
+    produce a `OrderedDict` mapping names to blocks.
 
-    return by_name
+    Blocks are named as in `name_blocks`, and blocks in the mapping have
+    their labels removed.
+    """
+    return OrderedDict(zip(*name_blocks(blocks)))
 
 
 def successors(instr):
@@ -45,25 +57,26 @@ def successors(instr):
         raise ValueError('{} is not a terminator'.format(instr['op']))
 
 
-def add_terminators(blocks):
-    """Given an ordered block map, modify the blocks to add terminators
-    to all blocks (avoiding "fall-through" control flow transfers).
+def _add_terminators(names, blocks):
+    """Add terminators to the blocks in the parallel lists `names` and
+    `blocks`, as in `add_terminators`.
     """
-    for i, block in enumerate(blocks.values()):
-        if not block:
-            if i == len(blocks) - 1:
+    last = len(blocks) - 1
+    for i, block in enumerate(blocks):
+        if not block or block[-1]['op'] not in TERMINATORS:
+            if i == last:
                 # In the last block, return.
                 block.append({'op': 'ret', 'args': []})
-            else:
-                dest = list(blocks.keys())[i + 1]
-                block.append({'op': 'jmp', 'labels': [dest]})
-        elif block[-1]['op'] not in TERMINATORS:
-            if i == len(blocks) - 1:
-                block.append({'op': 'ret', 'args': []})
             else:
                 # Otherwise, jump to the next block.
-                dest = list(blocks.keys())[i + 1]
-                block.append({'op': 'jmp', 'labels': [dest]})
+                block.append({'op': 'jmp', 'labels': [names[i + 1]]})
+
+
+def add_terminators(blocks):
+    """Given an ordered block map, modify the blocks to add terminators
+    to all blocks (avoiding "fall-through" control flow transfers).
+    """
+    _add_terminators(list(blocks.keys()), list(blocks.values()))
 
 
 def add_entry(blocks):
@@ -76,8 +89,8 @@ def add_entry(blocks):
     first_lbl = next(iter(blocks.keys()))
 
     # Check for any references to the label.
-    for instr in flatten(blocks.values()):
-        if 'labels' in instr and first_lbl in instr['labels']:
+    for block in blocks.values():
+        if any(first_lbl in instr.get('labels', ()) for instr in block):
             break
     else:
         return
@@ -88,18 +101,118 @@ def add_entry(blocks):
     blocks.move_to_end(new_lbl, last=False)
 
 
+class CFG:
+    """A control-flow graph whose blocks are numbered densely from 0 in
+    program order, so block 0 is the entry.
+
+    `names[i]` and `blocks[i]` are the name and instructions (without
+    the label) of block i, and `index` maps names back to numbers. Every
+    block must end in a terminator. The edges are stored in compact
+    arrays, CSR-style: the successors of block i are
+    `succ_ids[succ_start[i]:succ_start[i + 1]]`, in the order of the
+    terminator's labels, and the predecessors are likewise in
+    `pred_ids` and `pred_start`, in block order.
+
+    The successors come straight from the terminators, or from `succs`,
+    a parallel list of lists of successor names, if it is given.
+    """
+    def __init__(self, names, blocks, succs=None):
+        self.names = list(names)
+        self.blocks = list(blocks)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        if succs is None:
+            succs = (successors(block[-1]) for block in self.blocks)
+
+        index = self.index
+        self.succ_start = succ_start = array('l', [0])
+        self.succ_ids = succ_ids = array('l')
+        for labels in succs:
+            succ_ids.extend(index[lbl] for lbl in labels)
+            succ_start.append(len(succ_ids))
+
+        # Predecessors, by counting the edges into each block and then
+        # filling in the sources in block order.
+        counts = [0] * (len(self.names) + 1)
+        for dest in succ_ids:
+            counts[dest + 1] += 1
+        for i in range(len(self.names)):
+            counts[i + 1] += counts[i]
+        self.pred_start = array('l', counts)
+        self.pred_ids = array('l', [0]) * len(succ_ids)
+        for src in range(len(self.names)):
+            for dest in succ_ids[succ_start[src]:succ_start[src + 1]]:
+                self.pred_ids[counts[dest]] = src
+                counts[dest] += 1
+
+    @classmethod
+    def from_blocks(cls, blocks):
+        """Build a CFG from a sequence of basic blocks (as produced by
+        `form_blocks`), naming them and adding terminators, in a single
+        pass.
+        """
+        names, blocks = name_blocks(blocks)
+        _add_terminators(names, blocks)
+        return cls(names, blocks)
+
+    @classmethod
+    def from_block_map(cls, blocks):
+        """Build a CFG from a block map whose blocks all have terminators.
+        The CFG shares the block lists with the map.
+        """
+        return cls(blocks.keys(), blocks.values())
+
+    @classmethod
+    def from_succ(cls, succ):
+        """Build a CFG from a map from block names to lists of successor
+        names, like the one `edges` produces. The blocks are all None.
+        """
+        return cls(succ.keys(), [None] * len(succ), succ.values())
+
+    def __len__(self):
+        return len(self.names)
+
+    def succs(self, i):
+        """Get the successor ids of block `i`.
+        """
+        return self.succ_ids[self.succ_start[i]:self.succ_start[i + 1]]
+
+    def preds(self, i):
+        """Get the predecessor ids of block `i`.
+        """
+        return self.pred_ids[self.pred_start[i]:self.pred_start[i + 1]]
+
+    def postorder(self, root=None):
+        """Get the block ids in postorder (see `graphs.postorder`).
+        """
+        return graphs.postorder(self, root)
+
+    def sccs(self):
+        """Get the strongly connected components (see `graphs.sccs`).
+        """
+        return graphs.sccs(self)
+
+    def block_map(self):
+        """Get an `OrderedDict` mapping names to blocks.
+        """
+        return OrderedDict(zip(self.names, self.blocks))
+
+    def edges(self):
+        """Get the predecessor and successor mappings, as in `edges`.
+        """
+        names = self.names
+        preds = {name: [names[p] for p in self.preds(i)]
+                 for i, name in enumerate(names)}
+        succs = {name: [names[s] for s in self.succs(i)]
+                 for i, name in enumerate(names)}
+        return preds, succs
+
+
 def edges(blocks):
     """Given a block map containing blocks complete with terminators,
     generate two mappings: predecessors and successors. Both map block
     names to lists of block names.
     """
-    preds = {name: [] for name in blocks}
-    succs = {name: [] for name in blocks}
-    for name, block in blocks.items():
-        for succ in successors(block[-1]):
-            succs[name].append(succ)
-            preds[succ].append(name)
-    return preds, succs
+    return CFG.from_block_map(blocks).edges()
 
 
 def reassemble(blocks):
@@ -3,8 +3,8 @@ emit a GraphViz file.
 """
 
 from form_blocks import form_blocks
-import json
 import sys
+import briltxt
 from cfg import block_map, successors, add_terminators
 
 
@@ -14,8 +14,10 @@ def cfg_dot(bril, verbose):
 
     In `verbose` mode, include the instructions in the vertices.
     """
+    # Collect the output lines and write them all at once.
+    lines = []
     for func in bril['functions']:
-        print('digraph {} {{'.format(func['name']))
+        lines.append('digraph {} {{'.format(func['name']))
 
         blocks = block_map(form_blocks(func['instrs']))
 
@@ -25,23 +27,26 @@ def cfg_dot(bril, verbose):
         # Add the vertices.
         for name, block in blocks.items():
             if verbose:
-                import briltxt
-                print(r'  {} [shape=box, xlabel="{}", label="{}\l"];'.format(
-                    name,
-                    name,
-                    r'\l'.join(briltxt.instr_to_string(i) for i in block),
-                ))
+                lines.append(
+                    r'  {} [shape=box, xlabel="{}", label="{}\l"];'.format(
+                        name,
+                        name,
+                        r'\l'.join(briltxt.instr_to_string(i) for i in block),
+                    )
+                )
             else:
-                print('  {};'.format(name))
+                lines.append('  {};'.format(name))
 
         # Add the control-flow edges.
         for i, (name, block) in enumerate(blocks.items()):
             succ = successors(block[-1])
             for label in succ:
-                print('  {} -> {};'.format(name, label))
+                lines.append('  {} -> {};'.format(name, label))
 
-        print('}')
+        lines.append('}')
+
+    sys.stdout.write(''.join(line + '\n' for line in lines))
 
 
 if __name__ == '__main__':
-    cfg_dot(json.load(sys.stdin), '-v' in sys.argv[1:])
+    cfg_dot(briltxt.read_prog(sys.stdin)[0], '-v' in sys.argv[1:])
@@ -0,0 +1,94 @@
+"""Dead code elimination using live variables: delete instructions
+whose results are not live afterward, repeating until there are none.
+Unlike `tdce.py`, this catches assignments that are overwritten on every
+path before they are read, even in other blocks.
+
+Live variables are solved once. After each round of deletions, the
+changed blocks are reported to `df.DataFlow.update`, which re-solves
+only the blocks that depend on them, and the next round only revisits
+the blocks whose live-out sets changed.
+"""
+
+import sys
+
+import briltxt
+
+import cfg
+import df
+from form_blocks import form_blocks
+
+
+def sweep(block, live, number):
+    """Delete the instructions in `block` (a list of instruction dicts)
+    whose results are dead, given the bit mask `live` of the variables
+    that are live at the end of the block and the function `number`
+    that numbers variables. Return the deleted instructions.
+    """
+    keep = []
+    dead = []
+    for instr in reversed(block):
+        dest = instr.get('dest')
+        if dest is not None:
+            bit = 1 << number(dest)
+            # Calls may have side effects, so keep them even when their
+            # results are dead.
+            if not live & bit and instr['op'] != 'call':
+                dead.append(instr)
+                continue
+            live &= ~bit
+        for arg in instr.get('args', ()):
+            live |= 1 << number(arg)
+        keep.append(instr)
+
+    if dead:
+        keep.reverse()
+        block[:] = keep
+    return dead
+
+
+def live_dce(func, stats=None):
+    """Delete dead instructions from a function dict, in place, and
+    return it. If `stats` is a dict, count the `rounds` of deletion and
+    the `iterations` of the live variable solver in it.
+    """
+    graph = cfg.CFG.from_blocks(form_blocks(func['instrs']))
+    live = df.bit_dataflow(graph, df.BIT_ANALYSES['live'])
+    number = live.vars.number
+
+    # Sweep every block once, and then the blocks whose live-out sets
+    # shrank after the previous round.
+    deleted = set()
+    rounds = 0
+    todo = graph.names
+    while todo:
+        rounds += 1
+        changed = []
+        for name in todo:
+            i = graph.index[name]
+            dead = sweep(graph.blocks[i], live.in_[i], number)
+            if dead:
+                changed.append(name)
+                deleted.update(id(instr) for instr in dead)
+        todo = sorted(live.update(changed), key=graph.index.get) \
+            if changed else ()
+
+    if deleted:
+        func['instrs'] = [instr for instr in func['instrs']
+                          if id(instr) not in deleted]
+    if stats is not None:
+        stats['rounds'] = stats.get('rounds', 0) + rounds
+        stats['iterations'] = stats.get('iterations', 0) + live.iterations
+    return func
+
+
+def dce(bril, names=None, jobs=1):
+    return briltxt.transform_funcs(bril, live_dce, names, jobs)
+
+
+if __name__ == '__main__':
+    bril, binary = briltxt.read_prog(sys.stdin, lazy=True)
+    args = sys.argv[1:]
+    briltxt.write_prog(
+        dce(bril, briltxt.func_names(args), briltxt.jobs_arg(args)),
+        sys.stdout, binary,
+    )
@@ -1,9 +1,12 @@
+import heapq
 import sys
-import json
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+
+import briltxt
 
 from form_blocks import form_blocks
 import cfg
+import ir
 
 # A single dataflow analysis consists of these part:
 # - forward: True for forward, False for backward.
@@ -20,44 +23,366 @@ def union(sets):
     return out
 
 
-def df_worklist(blocks, analysis):
+class DataFlow:
+    """A data flow analysis solved on a `cfg.CFG`, which can be brought
+    up to date after passes edit the instructions in some blocks (but
+    not the edges between them).
+
+    Blocks are visited in reverse postorder for forward analyses and in
+    postorder for backward ones, so a block's inputs are usually settled
+    by the time it is visited. The worklist is a heap of positions in
+    that order, with a flag per block that keeps it from being queued
+    twice.
+
+    `in_` and `out` are lists of the values at the input and output of
+    each block in the direction of the analysis (so for a backward
+    analysis, `in_` holds the values at the ends of the blocks). The
+    transfer function gets each block's instructions, or the
+    corresponding element of `blocks` if that is given; `prepare`, if
+    given, computes that element from a block's instructions.
+    `iterations` counts the times a transfer function ran.
+    """
+    def __init__(self, graph, analysis, blocks=None, prepare=None,
+                 vars=None):
+        self.graph = graph
+        self.analysis = analysis
+        self.prepare = prepare
+        self.vars = vars  # For bit-vector analyses, the variable table.
+        if blocks is None:
+            blocks = graph.blocks if prepare is None else \
+                [prepare(block) for block in graph.blocks]
+        self.blocks = blocks
+
+        # Switch between directions.
+        order = graph.postorder()
+        if analysis.forward:
+            order.reverse()
+            self.in_edges = graph.preds
+            self.out_edges = graph.succs
+        else:
+            self.in_edges = graph.succs
+            self.out_edges = graph.preds
+        self.order = order
+        self.rank = [0] * len(graph)
+        for r, node in enumerate(order):
+            self.rank[node] = r
+
+        # Initialize, and solve with every block on the worklist.
+        self.in_ = [analysis.init] * len(graph)
+        self.out = [analysis.init] * len(graph)
+        self.iterations = 0
+        self._solve(range(len(graph)))
+        self._comp = None  # Strongly connected components, for updates.
+
+    def _solve(self, seeds):
+        """Iterate to a fixed point, starting with the block ids in
+        `seeds` on the worklist.
+        """
+        order, rank = self.order, self.rank
+        in_edges, out_edges = self.in_edges, self.out_edges
+        merge, transfer = self.analysis.merge, self.analysis.transfer
+        blocks, in_, out = self.blocks, self.in_, self.out
+
+        worklist = sorted(rank[node] for node in seeds)
+        queued = bytearray(len(order))
+        for node in seeds:
+            queued[node] = 1
+
+        iterations = 0
+        while worklist:
+            node = order[heapq.heappop(worklist)]
+            queued[node] = 0
+            iterations += 1
+
+            inval = merge(out[p] for p in in_edges(node))
+            in_[node] = inval
+
+            outval = transfer(blocks[node], inval)
+
+            if outval != out[node]:
+                out[node] = outval
+                for succ in out_edges(node):
+                    if not queued[succ]:
+                        queued[succ] = 1
+                        heapq.heappush(worklist, rank[succ])
+        self.iterations += iterations
+
+    def update(self, changed):
+        """Re-solve after the instructions in the blocks named in
+        `changed` were edited, and return the set of names of blocks
+        whose values changed.
+
+        Changes propagate from the edited blocks as in the initial
+        solve, starting from the previous values, so the cost depends
+        on how far the changes reach. In a cycle, though, an old value
+        could keep itself alive (say, a variable that is live only
+        because it was live around a loop). So a strongly connected
+        component with a cycle is reset to the initial value and solved
+        again from scratch the first time one of its blocks is edited
+        or an input from outside the component changes.
+        """
+        graph, init = self.graph, self.analysis.init
+        if self._comp is None:
+            self._comps = graph.sccs()
+            self._comp = [0] * len(graph)
+            for c, members in enumerate(self._comps):
+                for node in members:
+                    self._comp[node] = c
+            self._cyclic = [len(members) > 1 or
+                            members[0] in graph.succs(members[0])
+                            for members in self._comps]
+        comps, comp, cyclic = self._comps, self._comp, self._cyclic
+        order, rank = self.order, self.rank
+        in_edges, out_edges = self.in_edges, self.out_edges
+        merge, transfer = self.analysis.merge, self.analysis.transfer
+        blocks, in_, out = self.blocks, self.in_, self.out
+
+        old = {}  # The previous values of the blocks we touch.
+        worklist = []
+        queued = set()
+        reset = set()
+
+        def push(node):
+            if node not in queued:
+                queued.add(node)
+                heapq.heappush(worklist, rank[node])
+
+        def reset_comp(c):
+            reset.add(c)
+            for node in comps[c]:
+                if node not in old:
+                    old[node] = (in_[node], out[node])
+                if old[node][1] != init:
+                    # The block's value might end up back at the initial
+                    # value, so tell the blocks outside now.
+                    for succ in out_edges(node):
+                        if comp[succ] != c:
+                            push(succ)
+                out[node] = init
+                push(node)
+
+        for name in changed:
+            node = graph.index[name]
+            if self.prepare is not None:
+                blocks[node] = self.prepare(graph.blocks[node])
+            if not cyclic[comp[node]]:
+                push(node)
+            elif comp[node] not in reset:
+                reset_comp(comp[node])
+
+        iterations = 0
+        while worklist:
+            node = order[heapq.heappop(worklist)]
+            queued.discard(node)
+
+            c = comp[node]
+            if cyclic[c] and c not in reset:
+                # An input from outside the component may have changed.
+                # (Everything before it in the order has settled.)
+                outside = [p for p in in_edges(node) if comp[p] != c]
+                if merge(out[p] for p in outside) != \
+                        merge(old[p][1] if p in old else out[p]
+                              for p in outside):
+                    reset_comp(c)
+                continue
+
+            iterations += 1
+            if node not in old:
+                old[node] = (in_[node], out[node])
+
+            inval = merge(out[p] for p in in_edges(node))
+            in_[node] = inval
+
+            outval = transfer(blocks[node], inval)
+
+            if outval != out[node]:
+                out[node] = outval
+                for succ in out_edges(node):
+                    push(succ)
+
+        self.iterations += iterations
+        return {graph.names[node] for node, vals in old.items()
+                if (in_[node], out[node]) != vals}
+
+    def result(self):
+        """Get maps from block names to the values at the start and end
+        of each block.
+        """
+        in_ = dict(zip(self.graph.names, self.in_))
+        out = dict(zip(self.graph.names, self.out))
+        if self.analysis.forward:
+            return in_, out
+        else:
+            return out, in_
+
+
+def df_cfg(graph, analysis, stats=None, blocks=None):
+    """Solve a data flow analysis on the `cfg.CFG` `graph`, producing
+    maps from block names to the values at the start and end of each
+    block. The transfer function gets each block's instructions, or the
+    corresponding element of the list `blocks` if one is given. If
+    `stats` is a dict, `stats['iterations']` is set to the number of
+    times a transfer function ran. See `DataFlow`.
+    """
+    flow = DataFlow(graph, analysis, blocks)
+    if stats is not None:
+        stats['iterations'] = flow.iterations
+    return flow.result()
+
+
+def df_worklist(blocks, analysis, stats=None):
     """The worklist algorithm for iterating a data flow analysis to a
-    fixed point.
+    fixed point, on a block map whose blocks all have terminators. See
+    `df_cfg`.
     """
-    preds, succs = cfg.edges(blocks)
+    return df_cfg(cfg.CFG.from_block_map(blocks), analysis, stats)
 
-    # Switch between directions.
-    if analysis.forward:
-        first_block = list(blocks.keys())[0]  # Entry.
-        in_edges = preds
-        out_edges = succs
-    else:
-        first_block = list(blocks.keys())[-1]  # Exit.
-        in_edges = succs
-        out_edges = preds
 
-    # Initialize.
-    in_ = {first_block: analysis.init}
-    out = {node: analysis.init for node in blocks}
+# A bit-vector analysis, for problems whose values are sets of
+# variables. The variables are numbered once per function, and a set is
+# an int with a bit for each variable. Sets are merged by union, and a
+# block transforms its input into `gen | (input & ~kill)`.
+# - forward: True for forward, False for backward.
+# - gen_kill: Take a block and a function that numbers variable names,
+#   and produce the block's GEN and KILL bit masks.
+BitAnalysis = namedtuple('BitAnalysis', ['forward', 'gen_kill'])
+
+
+def bit_union(masks):
+    out = 0
+    for m in masks:
+        out |= m
+    return out
+
 
-    # Iterate.
-    worklist = list(blocks.keys())
-    while worklist:
-        node = worklist.pop(0)
+def bit_transfer(gen_kill, in_):
+    gen, kill = gen_kill
+    return gen | (in_ & ~kill)
 
-        inval = analysis.merge(out[n] for n in in_edges[node])
-        in_[node] = inval
 
-        outval = analysis.transfer(blocks[node], inval)
+def bits_to_set(mask, names):
+    """Decode a bit mask into the set of names (from the list `names`)
+    whose bits are set.
+    """
+    # Scan the binary digits, lowest bit first, in one pass.
+    digits = bin(mask)[:1:-1]
+    return {names[i] for i, d in enumerate(digits) if d == '1'}
+
+
+def bit_dataflow(graph, analysis):
+    """Solve the `BitAnalysis` `analysis` on the `cfg.CFG` `graph`,
+    producing a `DataFlow` whose values are bit masks and whose `vars`
+    is the `ir.Names` table that numbers the variables. Updates
+    recompute the GEN and KILL masks of the changed blocks.
+    """
+    vars = ir.Names()
+    gen_kill, number = analysis.gen_kill, vars.number
+    return DataFlow(
+        graph,
+        Analysis(analysis.forward, 0, bit_union, bit_transfer),
+        prepare=lambda block: gen_kill(block, number),
+        vars=vars,
+    )
+
+
+def df_bits(graph, analysis, stats=None):
+    """Solve the `BitAnalysis` `analysis` on the `cfg.CFG` `graph`.
+    Produce the `ir.Names` table that numbers the variables and maps
+    from block names to bit masks at the start and end of each block
+    (see `bits_to_set`).
+    """
+    flow = bit_dataflow(graph, analysis)
+    if stats is not None:
+        stats['iterations'] = flow.iterations
+    return (flow.vars,) + flow.result()
+
+
+def bit_step(analysis, vars):
+    """Get a function that transfers a bit mask across one instruction
+    for the `BitAnalysis` `analysis`, numbering variables in `vars`.
+    """
+    gen_kill, number = analysis.gen_kill, vars.number
+
+    def step(instr, mask):
+        return bit_transfer(gen_kill([instr], number), mask)
+    return step
+
+
+class InstrFacts:
+    """Data flow values at the points between instructions, computed on
+    demand from a solution for the blocks.
+
+    Point `i` in a block is just before its instruction `i`, and point
+    `len(block)` is the end of the block. `step(instr, value)` transfers
+    a value across one instruction, in the direction of the analysis.
+    The first query in a block replays `step` over the block from its
+    start value (or its end value, for a backward analysis) and keeps
+    the values at all of its points, but only for the `max_blocks` most
+    recently queried blocks.
+    """
+    def __init__(self, graph, forward, step, in_, out, vars=None,
+                 max_blocks=64):
+        self.graph = graph
+        self.forward = forward
+        self.step = step
+        self.in_ = in_
+        self.out = out
+        self.vars = vars  # For bit-vector analyses, the variable table.
+        self.max_blocks = max_blocks
+        self._tables = OrderedDict()
+
+    def _table(self, block):
+        table = self._tables.get(block)
+        if table is not None:
+            self._tables.move_to_end(block)
+            return table
+
+        instrs = self.graph.blocks[self.graph.index[block]]
+        step = self.step
+        if self.forward:
+            table = [self.in_[block]]
+            for instr in instrs:
+                table.append(step(instr, table[-1]))
+        else:
+            table = [self.out[block]]
+            for instr in reversed(instrs):
+                table.append(step(instr, table[-1]))
+            table.reverse()
+
+        self._tables[block] = table
+        if len(self._tables) > self.max_blocks:
+            self._tables.popitem(last=False)
+        return table
+
+    def before(self, block, i):
+        """The value just before instruction `i` of the named block.
+        """
+        return self._table(block)[i]
 
-        if outval != out[node]:
-            out[node] = outval
-            worklist += out_edges[node]
+    def after(self, block, i):
+        """The value just after instruction `i` of the named block.
+        """
+        return self._table(block)[i + 1]
 
-    if analysis.forward:
-        return in_, out
+
+def instr_facts(graph, analysis, max_blocks=64):
+    """Solve `analysis`, an `Analysis` or a `BitAnalysis`, on the
+    `cfg.CFG` `graph`, and get an `InstrFacts` for the values at each
+    instruction. (The transfer function of an `Analysis` is applied to
+    one-instruction blocks.)
+    """
+    if isinstance(analysis, BitAnalysis):
+        vars, in_, out = df_bits(graph, analysis)
+        step = bit_step(analysis, vars)
     else:
-        return out, in_
+        vars = None
+        in_, out = df_cfg(graph, analysis)
+        transfer = analysis.transfer
+
+        def step(instr, val):
+            return transfer([instr], val)
+    return InstrFacts(graph, analysis.forward, step, in_, out, vars,
+                      max_blocks)
 
 
 def fmt(val):
@@ -79,17 +404,35 @@ def fmt(val):
         return str(val)
 
 
-def run_df(bril, analysis):
+def run_df(bril, analysis, instrs=False):
+    """Print the values at the start and end of every block. With
+    `instrs`, also print each instruction and the value after it.
+    """
+    lines = []
     for func in bril['functions']:
         # Form the CFG.
         blocks = cfg.block_map(form_blocks(func['instrs']))
         cfg.add_terminators(blocks)
 
-        in_, out = df_worklist(blocks, analysis)
-        for block in blocks:
-            print('{}:'.format(block))
-            print('  in: ', fmt(in_[block]))
-            print('  out:', fmt(out[block]))
+        facts = instr_facts(cfg.CFG.from_block_map(blocks), analysis)
+        if facts.vars is None:
+            show = fmt
+        else:
+            def show(mask):
+                return fmt(bits_to_set(mask, facts.vars.names))
+
+        for block, block_instrs in blocks.items():
+            lines.append(block + ':\n')
+            lines.append('  in:  ' + show(facts.in_[block]) + '\n')
+            if instrs:
+                for i, instr in enumerate(block_instrs):
+                    lines.append('  ' + briltxt.instr_to_string(instr) + ';\n')
+                    lines.append('    after: ' + show(facts.after(block, i))
+                                 + '\n')
+            lines.append('  out: ' + show(facts.out[block]) + '\n')
+
+    # Write all the output at once.
+    sys.stdout.write(''.join(lines))
 
 
 def gen(block):
@@ -110,6 +453,33 @@ def use(block):
     return used
 
 
+def gen_bits(block, num):
+    """The GEN and KILL masks for `defined`: the variables written in
+    the block, and nothing.
+    """
+    written = 0
+    for i in block:
+        if 'dest' in i:
+            written |= 1 << num(i['dest'])
+    return written, 0
+
+
+def use_def_bits(block, num):
+    """The GEN and KILL masks for `live`: the variables read before they
+    are written in the block, and the variables written in it.
+    """
+    used = 0
+    written = 0
+    for i in block:
+        for v in i.get('args', ()):
+            bit = 1 << num(v)
+            if not written & bit:
+                used |= bit
+        if 'dest' in i:
+            written |= 1 << num(i['dest'])
+    return used, written
+
+
 def cprop_transfer(block, in_vals):
     out_vals = dict(in_vals)
     for instr in block:
@@ -164,6 +534,22 @@ ANALYSES = {
     ),
 }
 
+# Bit-vector versions of the set-based analyses above, which give the
+# same results. Use them from the command line with `--bits`. (With
+# `--instrs`, the command also prints the value after each instruction.)
+BIT_ANALYSES = {
+    'defined': BitAnalysis(True, gen_kill=gen_bits),
+    'live': BitAnalysis(False, gen_kill=use_def_bits),
+}
+
 if __name__ == '__main__':
-    bril = json.load(sys.stdin)
-    run_df(bril, ANALYSES[sys.argv[1]])
+    bits = '--bits' in sys.argv[2:]
+    analyses = BIT_ANALYSES if bits else ANALYSES
+    name = sys.argv[1] if len(sys.argv) > 1 else None
+    if name not in analyses:
+        sys.exit('usage: df.py ANALYSIS [--bits] [--instrs], where '
+                 'ANALYSIS{} is one of {}'.format(
+                     ' with --bits' if bits else '', ', '.join(analyses),
+                 ))
+    bril, _ = briltxt.read_prog(sys.stdin)
+    run_df(bril, analyses[name], '--instrs' in sys.argv[2:])
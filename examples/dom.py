@@ -1,8 +1,10 @@
 import json
 import sys
 
-from cfg import block_map, successors, add_terminators, add_entry
+import briltxt
+from cfg import CFG, block_map, add_terminators, add_entry
 from form_blocks import form_blocks
+from graphs import loop_forest, tree_walk
 
 
 def map_inv(succ):
@@ -18,90 +20,247 @@ def map_inv(succ):
     return out
 
 
-def postorder_helper(succ, root, explored, out):
-    """Given a successor edge map, produce a list of all the nodes in
-    the graph in postorder by appending to the `out` list.
+def postorder(succ, root):
+    """Given a successor edge map, produce a list of the nodes reachable
+    from `root` in postorder.
     """
-    if root in explored:
-        return
-    explored.add(root)
-
-    for s in succ[root]:
-        postorder_helper(succ, s, explored, out)
-    out.append(root)
+    graph = CFG.from_succ(succ)
+    return [graph.names[i] for i in graph.postorder(graph.index[root])]
 
 
-def postorder(succ, root):
-    out = []
-    postorder_helper(succ, root, set(), out)
-    return out
-
+def get_idom(graph, entry=0):
+    """Find the immediate dominator of every block in the `cfg.CFG`
+    `graph` with the iterative algorithm of Cooper, Harvey, and Kennedy
+    ("A Simple, Fast Dominance Algorithm"). Produce a list mapping each
+    block id to the id of its immediate dominator. The entry is its own
+    immediate dominator, and blocks that cannot be reached from the
+    entry get -1.
+    """
+    order = graph.postorder(entry)
+    po_num = [-1] * len(graph)
+    for i, node in enumerate(order):
+        po_num[node] = i
+
+    def intersect(a, b):
+        # Walk up from both blocks until the paths meet.
+        while a != b:
+            while po_num[a] < po_num[b]:
+                a = idom[a]
+            while po_num[b] < po_num[a]:
+                b = idom[b]
+        return a
+
+    idom = [-1] * len(graph)
+    idom[entry] = entry
+    rpo = order[-2::-1]  # Everything but the entry, in reverse postorder.
+    changed = True
+    while changed:
+        changed = False
+        for node in rpo:
+            new_idom = -1
+            for p in graph.preds(node):
+                if idom[p] != -1:  # Skip unprocessed predecessors.
+                    new_idom = p if new_idom == -1 else intersect(p, new_idom)
+            if idom[node] != new_idom:
+                idom[node] = new_idom
+                changed = True
+    return idom
 
-def intersect(sets):
-    sets = list(sets)
-    if not sets:
-        return set()
-    out = set(sets[0])
-    for s in sets[1:]:
-        out &= s
-    return out
 
+def idom_tree(idom):
+    """Get the dominator tree from the immediate dominators, as a list
+    mapping each block id to the list of its children, in id order.
+    """
+    children = [[] for _ in idom]
+    for node, parent in enumerate(idom):
+        if parent != -1 and parent != node:
+            children[parent].append(node)
+    return children
+
+
+class DomTree:
+    """The dominator tree given by a list of immediate dominators (as
+    `get_idom` produces), numbered for fast queries.
+
+    A depth-first walk of the tree gives each block a `pre` and a `post`
+    number, so that `a` dominates `b` exactly when `b`'s numbers nest
+    inside `a`'s; each dominance query is two comparisons. Blocks that
+    cannot be reached from the entry are numbered -1 and dominate, and
+    are dominated by, nothing.
+    """
+    def __init__(self, idom):
+        self.idom = idom
+        self.children = idom_tree(idom)
+        n = len(idom)
+        self.pre = pre = [-1] * n
+        self.post = post = [-1] * n
+
+        # The root is the entry: the only block that is its own
+        # immediate dominator.
+        self.root = next((b for b, d in enumerate(idom) if b == d), None)
+        if self.root is not None:
+            counter = 0
+            for node, entering in tree_walk(self.children, self.root):
+                if entering:
+                    pre[node] = counter
+                else:
+                    post[node] = counter
+                counter += 1
+
+    def dominates(self, a, b):
+        """Does block `a` dominate block `b`? (Every reachable block
+        dominates itself.)
+        """
+        return self.pre[a] <= self.pre[b] and self.post[b] <= self.post[a] \
+            and self.pre[b] != -1
+
+    def strictly_dominates(self, a, b):
+        return a != b and self.dominates(a, b)
+
+    def nca(self, a, b):
+        """Get the nearest common dominator of the reachable blocks `a`
+        and `b`: their nearest common ancestor in the tree. Either block
+        may be -1 (for no block), in which case the other is returned.
+        """
+        if a == -1:
+            return b
+        if b == -1:
+            return a
+        # Climb from `a` until we reach a block that dominates `b`.
+        idom = self.idom
+        while not self.dominates(a, b):
+            a = idom[a]
+        return a
+
+    def nca_all(self, blocks):
+        """Get the nearest common dominator of any number of blocks, or
+        -1 if there are none.
+        """
+        out = -1
+        for b in blocks:
+            out = self.nca(out, b)
+        return out
+
+
+def idom_fronts(graph, idom):
+    """Get the dominance frontiers from the immediate dominators, as a
+    list mapping each block id to a set of block ids. Each join point is
+    in the frontier of the blocks on the way up the dominator tree from
+    its predecessors to its immediate dominator.
+    """
+    fronts = [set() for _ in idom]
+    for node in range(len(graph)):
+        preds = graph.preds(node)
+        if idom[node] == -1 or len(preds) < 2:
+            continue
+        for runner in preds:
+            if idom[runner] == -1:
+                continue  # An unreachable predecessor.
+            while runner != idom[node]:
+                fronts[runner].add(node)
+                runner = idom[runner]
+    return fronts
+
+
+def reverse_cfg(graph):
+    """Reverse the edges of the `cfg.CFG` `graph`, adding a virtual exit
+    block (with id `len(graph)`) that every block without successors
+    jumps to. The exit is the entry of the reversed graph. Its blocks
+    are all None.
+    """
+    n = len(graph)
+    succs = [[graph.names[p] for p in graph.preds(i)] for i in range(n)]
+    succs.append([graph.names[i] for i in range(n) if not graph.succs(i)])
+    return CFG(graph.names + [None], [None] * (n + 1), succs)
 
-def get_dom(succ, entry):
-    pred = map_inv(succ)
-    nodes = list(reversed(postorder(succ, entry)))  # Reverse postorder.
 
-    dom = {v: set(nodes) for v in succ}
+def get_ipdom(rev):
+    """Find the immediate post-dominator of every block, given the
+    reversed CFG from `reverse_cfg`: its immediate dominators. Produce a
+    list with an entry for every block and, last, the virtual exit.
+    Blocks that cannot reach an exit (in infinite loops) get -1.
+    """
+    return get_idom(rev, len(rev) - 1)
 
-    while True:
-        changed = False
 
-        for node in nodes:
-            new_dom = intersect(dom[p] for p in pred[node])
-            new_dom.add(node)
+def control_deps(rev, ipdom):
+    """Get the control dependences of every block, given the reversed
+    CFG and the immediate post-dominators: a list mapping each block id
+    to the set of the ids of the blocks whose branches decide whether it
+    runs. These are the dominance frontiers of the reversed graph.
+    """
+    return idom_fronts(rev, ipdom)[:-1]
 
-            if dom[node] != new_dom:
-                dom[node] = new_dom
-                changed = True
 
-        if not changed:
-            break
+def _idom_of_dom(dom):
+    """Recover a name-keyed CFG and immediate dominators from a
+    dominance relation. The immediate dominator is the strict dominator
+    with the most dominators itself. (Blocks that do not dominate
+    themselves are the unreachable ones, as `get_dom` leaves them.)
+    """
+    index = {name: i for i, name in enumerate(dom)}
+    idom = [-1] * len(dom)
+    for name, doms in dom.items():
+        if name in doms:
+            strict = [d for d in doms if d != name]
+            idom[index[name]] = index[max(strict, key=lambda d: len(dom[d]))] \
+                if strict else index[name]
+    return index, idom
+
+
+def dom_sets(names, idom):
+    """Get the dominators of each block from the immediate dominators:
+    a map from each block's name (from the list `names`) to the set of
+    the names of its dominators. Blocks that cannot be reached from the
+    entry are mapped to the set of all the blocks that can.
+    """
+    reachable = {names[i] for i, d in enumerate(idom) if d != -1}
 
+    dom = {}
+    for i, name in enumerate(names):
+        if idom[i] == -1:
+            dom[name] = set(reachable)
+        else:
+            # Walk up the tree.
+            doms = dom[name] = {name}
+            while idom[i] != i:
+                i = idom[i]
+                doms.add(names[i])
     return dom
 
 
-def dom_fronts(dom, succ):
-    """Compute the dominance frontier, given the dominance relation.
+def get_dom(succ, entry):
+    """Compute the dominators of each block, given the successor edge
+    map and the name of the entry: a map from each block's name to the
+    set of the names of its dominators. (This is a view of `get_idom`.)
     """
-    dom_inv = map_inv(dom)
-
-    frontiers = {}
-    for block in dom:
-        # Find all successors of dominated blocks.
-        dominated_succs = set()
-        for dominated in dom_inv[block]:
-            dominated_succs.update(succ[dominated])
+    graph = CFG.from_succ(succ)
+    return dom_sets(graph.names, get_idom(graph, graph.index[entry]))
 
-        # You're in the frontier if you're not strictly dominated by the
-        # current block.
-        frontiers[block] = [b for b in dominated_succs
-                            if b not in dom_inv[block] or b == block]
 
-    return frontiers
+def dom_fronts(dom, succ):
+    """Compute the dominance frontier, given the dominance relation: a
+    map from each block's name to a list of the names of the blocks in
+    its frontier. (This is a view of `idom_fronts`.)
+    """
+    index, idom = _idom_of_dom(dom)
+    names = list(dom)
+    graph = CFG(names, [None] * len(names),
+                ([s for s in succ[name] if s in index] for name in names))
+    fronts = idom_fronts(graph, idom)
+    return {name: [names[b] for b in fronts[i]]
+            for i, name in enumerate(names)}
 
 
 def dom_tree(dom):
-    # Get the blocks strictly dominated by a block strictly dominated by
-    # a given block.
-    dom_inv = map_inv(dom)
-    dom_inv_strict = {a: {b for b in bs if b != a}
-                      for a, bs in dom_inv.items()}
-    dom_inv_strict_2x = {a: set().union(*(dom_inv_strict[b] for b in bs))
-                         for a, bs in dom_inv_strict.items()}
-    return {
-        a: {b for b in bs if b not in dom_inv_strict_2x[a]}
-        for a, bs in dom_inv_strict.items()
-    }
+    """Compute the dominator tree, given the dominance relation: a map
+    from each block's name to the set of the names of its children.
+    (This is a view of `idom_tree`.)
+    """
+    index, idom = _idom_of_dom(dom)
+    names = list(dom)
+    return {name: {names[c] for c in children}
+            for name, children in zip(names, idom_tree(idom))}
 
 
 def print_dom(bril, mode):
@@ -109,25 +268,52 @@ def print_dom(bril, mode):
         blocks = block_map(form_blocks(func['instrs']))
         add_entry(blocks)
         add_terminators(blocks)
-        succ = {name: successors(block[-1]) for name, block in blocks.items()}
-        dom = get_dom(succ, list(blocks.keys())[0])
+        graph = CFG.from_block_map(blocks)
+        idom = get_idom(graph)
+        names = graph.names
 
         if mode == 'front':
-            res = dom_fronts(dom, succ)
+            res = {name: sorted(names[b] for b in front)
+                   for name, front in zip(names, idom_fronts(graph, idom))}
         elif mode == 'tree':
-            res = dom_tree(dom)
+            res = {name: sorted(names[c] for c in children)
+                   for name, children in zip(names, idom_tree(idom))}
+        elif mode == 'loops':
+            loops, _ = loop_forest(graph, DomTree(idom))
+            res = [{
+                'header': names[loop.header],
+                'depth': loop.depth,
+                'parent': None if loop.parent is None
+                else names[loop.parent.header],
+                'blocks': sorted(names[b] for b in loop.blocks),
+                'exits': [names[b] for b in loop.exits],
+            } for loop in loops]
+        elif mode == 'ipdom':
+            # Blocks that exit the function are post-dominated by the
+            # virtual exit, None.
+            ipdom = get_ipdom(reverse_cfg(graph))
+            res = {name: names[d] if 0 <= d < len(graph) else None
+                   for name, d in zip(names, ipdom)}
+        elif mode == 'cdeps':
+            rev = reverse_cfg(graph)
+            cdeps = control_deps(rev, get_ipdom(rev))
+            res = {name: sorted(names[b] for b in deps)
+                   for name, deps in zip(names, cdeps)}
+        elif mode == 'idom':
+            # The entry and unreachable blocks have no immediate
+            # dominator.
+            res = {name: names[d] if d not in (-1, i) else None
+                   for i, (name, d) in enumerate(zip(names, idom))}
         else:
-            res = dom
+            res = {name: sorted(doms)
+                   for name, doms in dom_sets(names, idom).items()}
 
         # Format as JSON for stable output.
-        print(json.dumps(
-            {k: sorted(list(v)) for k, v in res.items()},
-            indent=2, sort_keys=True,
-        ))
+        print(json.dumps(res, indent=2, sort_keys=True))
 
 
 if __name__ == '__main__':
     print_dom(
-        json.load(sys.stdin),
+        briltxt.read_prog(sys.stdin)[0],
         'dom' if len(sys.argv) < 2 else sys.argv[1]
     )
@@ -1,47 +1,323 @@
-import json
+"""Convert functions out of SSA form.
+
+Phi-nodes are replaced by copies, but as few as possible:
+
+1. Coalescing. Each phi-node's destination and arguments are merged
+   into one variable when their live ranges do not overlap, so their
+   copies vanish. In SSA form, two variables interfere exactly when one
+   is live where the other is defined.
+2. Critical-edge splitting. The copies for an edge go at the end of its
+   source block. If that block has other successors, they go at the
+   start of the destination block instead, and if that block has other
+   predecessors too, the edge gets a new block of its own.
+3. Parallel copies. Bril runs phi-nodes in order, so arguments that
+   name an earlier phi-node's destination are first replaced by that
+   phi-node's argument. Then all of an edge's copies happen "at once",
+   so they are ordered to read every variable before it is
+   overwritten, and a cycle (like a swap) is broken with a temporary.
+"""
+
 import sys
+from collections import OrderedDict, defaultdict
+
+import briltxt
+
+from analysis import AnalysisManager
+from cfg import reassemble
+from util import fresh_names
+
+
+def ssa_liveness(graph, defs):
+    """Find where the variables of an SSA-form function are live, given
+    `defs`, a map from each variable to its definition's (block id,
+    position). The argument of a phi-node is used at the end of the
+    corresponding predecessor, not in the phi-node's block.
+
+    Produce lists mapping block ids to the sets of variables live at
+    their starts and ends, and a dict mapping (block id, variable) pairs
+    to the position of the variable's last ordinary use in the block.
+    """
+    live_in = [set() for _ in graph.blocks]
+    live_out = [set() for _ in graph.blocks]
+    last_use = {}
+
+    def live_at_start(var, node):
+        # Walk backward from a block where the variable is live on entry
+        # until we reach its definition.
+        work = [node]
+        while work:
+            node = work.pop()
+            if var in live_in[node]:
+                continue
+            live_in[node].add(var)
+            for p in graph.preds(node):
+                live_out[p].add(var)
+                if defs.get(var, (None,))[0] != p:
+                    work.append(p)
+
+    for node, block in enumerate(graph.blocks):
+        for pos, instr in enumerate(block):
+            if instr.get('op') == 'phi':
+                for label, var in zip(instr['labels'], instr['args']):
+                    p = graph.index[label]
+                    live_out[p].add(var)
+                    if defs.get(var, (None,))[0] != p:
+                        live_at_start(var, p)
+                continue
+            for var in instr.get('args', ()):
+                last_use[node, var] = pos
+                if defs.get(var, (None,))[0] != node:
+                    live_at_start(var, node)
+    return live_in, live_out, last_use
+
+
+def coalesce(graph, dominance, defs, phis, live_in, live_out, last_use):
+    """Merge each phi-node's destination with its arguments wherever
+    they do not interfere. Produce a map from variables to the names of
+    the variables they are merged into.
+
+    Two variables can only interfere in a block where both are live or
+    defined, so each class of merged variables keeps its members by the
+    blocks they occupy, and only pairs that share a block are checked.
+    """
+    def live_at_def(a, b):
+        # Is `a` live just after `b` is defined, where `a` is defined
+        # first?
+        node, pos = defs[b]
+        return a in live_out[node] or last_use.get((node, a), -1) > pos
+
+    def interfere(a, b):
+        if a not in defs or b not in defs:
+            return False  # Undefined variables hold nothing.
+        (na, pa), (nb, pb) = defs[a], defs[b]
+        if na == nb and pa == pb:
+            # Phi-nodes in the same block (or function arguments) are
+            # all defined at once.
+            return True
+        if dominance.dominates(na, nb) and (na != nb or pa < pb):
+            return live_at_def(a, b)
+        if dominance.dominates(nb, na):
+            return live_at_def(b, a)
+        return False  # Neither is live where the other is defined.
+
+    # The blocks each variable occupies.
+    blocks = defaultdict(set)
+    for var, (node, _) in defs.items():
+        blocks[var].add(node)
+    for live in (live_in, live_out):
+        for node, vars in enumerate(live):
+            for var in vars:
+                blocks[var].add(node)
+
+    # Union-find over variables, with the members of each class and a
+    # map from the blocks they occupy to the members there.
+    leader = {}
+    members = {}
+    occupants = {}
 
-from cfg import block_map, add_terminators, add_entry, reassemble
-from form_blocks import form_blocks
+    def find(var):
+        if var not in leader:
+            leader[var] = var
+            members[var] = [var]
+            occupants[var] = {node: [var] for node in blocks[var]}
+        root = var
+        while leader[root] != root:
+            root = leader[root]
+        while leader[var] != root:
+            leader[var], var = root, leader[var]
+        return root
 
+    def classes_interfere(a, b):
+        occ_a, occ_b = occupants[a], occupants[b]
+        if len(occ_a) > len(occ_b):
+            occ_a, occ_b = occ_b, occ_a
+        return any(interfere(x, y)
+                   for node, xs in occ_a.items() if node in occ_b
+                   for x in xs for y in occ_b[node])
 
-def func_from_ssa(func):
-    blocks = block_map(form_blocks(func['instrs']))
-    add_entry(blocks)
-    add_terminators(blocks)
+    for phi in phis:
+        for arg in phi['args']:
+            a, b = find(phi['dest']), find(arg)
+            if a == b or classes_interfere(a, b):
+                continue
+            if len(members[a]) < len(members[b]):
+                a, b = b, a
+            leader[b] = a
+            members[a] += members.pop(b)
+            occ = occupants[a]
+            for node, vars in occupants.pop(b).items():
+                occ.setdefault(node, []).extend(vars)
 
-    # Replace each phi-node.
-    for block in blocks.values():
-        # Insert copies for each phi.
+    # Name each class after its earliest definition, so function
+    # arguments keep their names.
+    order = defaultdict(lambda: (len(graph), 0))
+    order.update(defs)
+    rename = {}
+    for group in members.values():
+        name = min(group, key=lambda v: (order[v], v))
+        for var in group:
+            if var != name:
+                rename[var] = name
+    return rename
+
+
+def sequentialize(copies, temps):
+    """Order a parallel copy, given as a list of (dest, src) pairs with
+    distinct destinations, into a list of (dest, src) pairs that can run
+    one at a time. A copy runs only once nothing else needs to read its
+    destination; a cycle is broken by saving one destination in a
+    temporary from the iterator `temps`, which is yielded as its dest.
+    """
+    pending = OrderedDict((d, s) for d, s in copies if d != s)
+    readers = defaultdict(int)
+    for s in pending.values():
+        readers[s] += 1
+
+    out = []
+    while pending:
+        ready = [d for d in pending if not readers[d]]
+        if not ready:
+            # Every destination is still to be read: all cycles. Save
+            # one destination and read the saved copy instead.
+            d = next(iter(pending))
+            tmp = next(temps)
+            out.append((tmp, d))
+            for dest, src in pending.items():
+                if src == d:
+                    pending[dest] = tmp
+                    readers[d] -= 1
+            continue
+        for d in ready:
+            s = pending.pop(d)
+            out.append((d, s))
+            readers[s] -= 1
+    return out
+
+
+def parallelize_phis(block):
+    """Bril runs a block's phi-nodes one after another, so a phi-node
+    whose argument names an earlier phi-node's destination reads the
+    value that phi-node just got. Replace each such argument with the
+    earlier phi-node's argument for the same edge, so that all the
+    phi-nodes read the values from before the block and can be treated
+    as one parallel copy.
+    """
+    got = {}  # (label, dest) pairs to the argument for that edge.
+    for instr in block:
+        if instr.get('op') == 'phi':
+            pairs = list(zip(instr['labels'], instr['args']))
+            instr['args'] = [got.get((label, arg), arg)
+                             for label, arg in pairs]
+            for label, arg in zip(instr['labels'], instr['args']):
+                got[label, instr['dest']] = arg
+
+
+def func_from_ssa(func, am=None):
+    """Convert a function out of SSA form. Get the CFG and dominator
+    tree from the `AnalysisManager` `am`, if there is one.
+    """
+    am = am or AnalysisManager()
+    graph = am.get(func, 'cfg')
+    blocks = graph.block_map()
+
+    for block in graph.blocks:
+        parallelize_phis(block)
+
+    # Find the definitions and the phi-nodes.
+    defs = {}
+    types = {}
+    for arg in func.get('args', ()):
+        defs[arg['name']] = (0, -2)
+        types[arg['name']] = arg['type']
+    phis = []
+    for node, block in enumerate(graph.blocks):
+        for pos, instr in enumerate(block):
+            if 'dest' in instr:
+                if instr.get('op') == 'phi':
+                    phis.append(instr)
+                    pos = -1
+                defs[instr['dest']] = (node, pos)
+                types[instr['dest']] = instr['type']
+
+    if phis:
+        live_in, live_out, last_use = ssa_liveness(graph, defs)
+        rename = coalesce(graph, am.get(func, 'dominance'), defs, phis,
+                          live_in, live_out, last_use)
+    else:
+        rename = {}
+
+    # Rename merged variables.
+    if rename:
+        for arg in func.get('args', ()):
+            arg['name'] = rename.get(arg['name'], arg['name'])
+        for block in graph.blocks:
+            for instr in block:
+                if 'dest' in instr:
+                    instr['dest'] = rename.get(instr['dest'], instr['dest'])
+                if 'args' in instr:
+                    instr['args'] = [rename.get(a, a) for a in instr['args']]
+    used = {a for instr in func['instrs'] for a in instr.get('args', ())}
+    temps = fresh_names('tmp', used | set(types))
+
+    # Gather the copies for each edge, and remove the phis.
+    copies = OrderedDict()
+    for name, block in blocks.items():
         for instr in block:
             if instr.get('op') == 'phi':
-                dest = instr['dest']
-                type = instr['type']
-                for i, label in enumerate(instr['labels']):
-                    var = instr['args'][i]
-
-                    # Insert a copy in the predecessor block, before the
-                    # terminator.
-                    pred = blocks[label]
-                    pred.insert(-1, {
-                        'op': 'id',
-                        'type': type,
-                        'args': [var],
-                        'dest': dest,
-                    })
-
-        # Remove all phis.
-        new_block = [i for i in block if i.get('op') != 'phi']
-        block[:] = new_block
+                for label, var in zip(instr['labels'], instr['args']):
+                    edge = copies.setdefault((label, name), OrderedDict())
+                    edge[instr['dest']] = var
+        if any(instr.get('op') == 'phi' for instr in block):
+            block[:] = [i for i in block if i.get('op') != 'phi']
+
+    # Place each edge's copies, splitting it if it is critical.
+    split = {}
+    split_labels = fresh_names('split', blocks)
+    for (pred, succ), edge in copies.items():
+        instrs = []
+        for dest, src in sequentialize(edge.items(), temps):
+            type = types.get(dest) or types[src]
+            types.setdefault(dest, type)
+            instrs.append({'op': 'id', 'type': type, 'args': [src],
+                           'dest': dest})
+        if not instrs:
+            continue
+
+        p, s = graph.index[pred], graph.index[succ]
+        if len(graph.succs(p)) == 1:
+            blocks[pred][-1:-1] = instrs
+        elif len(graph.preds(s)) == 1:
+            blocks[succ][:0] = instrs
+        else:
+            label = next(split_labels)
+            blocks[label] = instrs + [{'op': 'jmp', 'labels': [succ]}]
+            split.setdefault(pred, []).append(label)
+            term = blocks[pred][-1]
+            term['labels'] = [label if lbl == succ else lbl
+                              for lbl in term['labels']]
+
+    # Put each new block after its predecessor.
+    if split:
+        order = []
+        for name in graph.names:
+            order.append(name)
+            order += split.get(name, ())
+        blocks = OrderedDict((name, blocks[name]) for name in order)
 
     func['instrs'] = reassemble(blocks)
+    am.invalidate(func['name'])
+
+
+def _func_from_ssa(func):
+    func_from_ssa(func)
+    return func
 
 
-def from_ssa(bril):
-    for func in bril['functions']:
-        func_from_ssa(func)
-    return bril
+def from_ssa(bril, jobs=1):
+    return briltxt.transform_funcs(bril, _func_from_ssa, jobs=jobs)
 
 
 if __name__ == '__main__':
-    print(json.dumps(from_ssa(json.load(sys.stdin)), indent=2, sort_keys=True))
+    bril, binary = briltxt.read_prog(sys.stdin)
+    briltxt.write_prog(from_ssa(bril, briltxt.jobs_arg(sys.argv[1:])),
+                       sys.stdout, binary)
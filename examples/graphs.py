@@ -0,0 +1,210 @@
+"""Graph algorithms on `cfg.CFG`s and dominator trees: depth-first
+orders, strongly connected components, and the loop-nesting forest.
+
+Everything here is iterative, with explicit stacks, so functions with
+very long chains of blocks or very deep dominator trees do not hit
+Python's recursion limit.
+"""
+
+
+def postorder(graph, root=None):
+    """Get the list of block ids in postorder of a depth-first search
+    from the entry, visiting successors in order. Blocks that cannot be
+    reached from the entry come last, each searched from in block order.
+    If `root` is given, get only the blocks reachable from it, starting
+    the search there.
+    """
+    succ_start, succ_ids = graph.succ_start, graph.succ_ids
+    visited = bytearray(len(graph))
+    order = []
+    for root in range(len(graph)) if root is None else (root,):
+        if visited[root]:
+            continue
+        visited[root] = 1
+
+        # Each stack entry is a block and the position of the next
+        # successor edge to follow.
+        stack = [(root, succ_start[root])]
+        while stack:
+            node, pos = stack[-1]
+            if pos < succ_start[node + 1]:
+                stack[-1] = (node, pos + 1)
+                succ = succ_ids[pos]
+                if not visited[succ]:
+                    visited[succ] = 1
+                    stack.append((succ, succ_start[succ]))
+            else:
+                stack.pop()
+                order.append(node)
+    return order
+
+
+def reverse_postorder(graph, root=None):
+    """Get the block ids in reverse postorder (see `postorder`).
+    """
+    order = postorder(graph, root)
+    order.reverse()
+    return order
+
+
+def sccs(graph):
+    """Get the strongly connected components, as lists of block ids,
+    using Tarjan's algorithm. Every component comes before the
+    components that have edges to it.
+    """
+    succ_start, succ_ids = graph.succ_start, graph.succ_ids
+    n = len(graph)
+    index = [-1] * n
+    low = [0] * n
+    on_stack = bytearray(n)
+    stack = []
+    comps = []
+    counter = 0
+    for root in range(n):
+        if index[root] >= 0:
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = 1
+
+        # As in `postorder`, each entry is a block and the position of
+        # its next successor edge.
+        work = [(root, succ_start[root])]
+        while work:
+            node, pos = work[-1]
+            if pos < succ_start[node + 1]:
+                work[-1] = (node, pos + 1)
+                succ = succ_ids[pos]
+                if index[succ] < 0:
+                    index[succ] = low[succ] = counter
+                    counter += 1
+                    stack.append(succ)
+                    on_stack[succ] = 1
+                    work.append((succ, succ_start[succ]))
+                elif on_stack[succ] and index[succ] < low[node]:
+                    low[node] = index[succ]
+            else:
+                work.pop()
+                if work and low[node] < low[work[-1][0]]:
+                    low[work[-1][0]] = low[node]
+                if low[node] == index[node]:
+                    # The node is the root of a component.
+                    comp = []
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = 0
+                        comp.append(member)
+                        if member == node:
+                            break
+                    comps.append(comp)
+    return comps
+
+
+def tree_walk(children, root):
+    """Walk a tree depth-first from `root`, where `children` maps each
+    node to a sequence of its children. Generate a (node, True) pair on
+    the way down to each node, before its children, and a (node, False)
+    pair on the way back up, after them.
+    """
+    yield root, True
+    stack = [(root, iter(children[root]))]
+    while stack:
+        node, kids = stack[-1]
+        for child in kids:
+            yield child, True
+            stack.append((child, iter(children[child])))
+            break
+        else:
+            stack.pop()
+            yield node, False
+
+
+class Loop:
+    """A natural loop in a loop-nesting forest. `header` is the block id
+    of the loop header, `blocks` is the set of the ids of all the blocks
+    in the loop (including those in nested loops), `parent` is the
+    enclosing `Loop` (or None), `children` lists the loops nested
+    directly inside, `depth` is 1 for outermost loops, and `exits` is
+    the sorted list of the ids of blocks outside the loop that it jumps
+    to.
+    """
+    __slots__ = ('header', 'blocks', 'parent', 'children', 'depth', 'exits')
+
+    def __init__(self, header):
+        self.header = header
+        self.blocks = {header}
+        self.parent = None
+        self.children = []
+        self.depth = 1
+        self.exits = []
+
+
+def loop_forest(graph, dominance):
+    """Find the natural loops of the `cfg.CFG` `graph` and how they nest,
+    given its `dom.DomTree`. A back edge is an edge to a block that
+    dominates its source; loops with the same header are merged.
+
+    Produce a list of `Loop`s, with inner loops before the loops that
+    contain them, and a list mapping each block id to the index of the
+    innermost loop containing it (or -1).
+
+    Headers are visited in postorder of the dominator tree, so inner
+    loops are found first. The body of a loop is found by walking
+    backward from its back edges; a walk that reaches a block of an
+    inner loop skips straight to that loop's header.
+    """
+    pre = dominance.pre
+    loops = []
+    loop_of = [-1] * len(graph)
+    if dominance.root is None:
+        return loops, loop_of
+
+    for header, entering in tree_walk(dominance.children, dominance.root):
+        if entering:
+            continue
+        latches = [p for p in graph.preds(header)
+                   if dominance.dominates(header, p)]
+        if not latches:
+            continue
+
+        lid = len(loops)
+        loop = Loop(header)
+        loops.append(loop)
+        loop_of[header] = lid
+        work = latches
+        while work:
+            node = work.pop()
+            if pre[node] == -1:
+                continue  # Unreachable blocks are in no loop.
+            inner = loop_of[node]
+            if inner == -1:
+                loop_of[node] = lid
+                work.extend(graph.preds(node))
+                continue
+
+            # Find the outermost loop found so far around the block. If
+            # it is a new subloop, adopt it and carry on from the
+            # predecessors of its header.
+            outer = loops[inner]
+            while outer.parent is not None:
+                outer = outer.parent
+            if outer is not loop:
+                outer.parent = loop
+                loop.children.append(outer)
+                work.extend(graph.preds(outer.header))
+
+    # Collect the blocks of each loop, inner loops first, and then the
+    # depths, outer loops first.
+    for node, lid in enumerate(loop_of):
+        if lid != -1:
+            loops[lid].blocks.add(node)
+    for loop in loops:
+        for child in loop.children:
+            loop.blocks |= child.blocks
+        loop.exits = sorted({s for b in loop.blocks for s in graph.succs(b)
+                             if s not in loop.blocks})
+    for loop in reversed(loops):
+        if loop.parent is not None:
+            loop.depth = loop.parent.depth + 1
+    return loops, loop_of
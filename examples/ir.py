@@ -0,0 +1,246 @@
+"""A compact in-memory representation of Bril functions.
+
+Instructions, blocks, and functions are `__slots__` objects instead of
+dicts. Opcodes are interned strings, and variables and labels are
+numbered densely per function (see `Names`), so passes can keep sets and
+maps of small integers instead of strings. `from_json` and `to_json`
+convert to and from the JSON form without losing anything.
+"""
+
+import functools
+import sys
+
+import briltxt
+
+from form_blocks import TERMINATORS
+
+
+class Names(dict):
+    """A table that numbers names (of variables or labels) densely,
+    starting at 0. Looking up a name gets its number, adding the name if
+    it is new, and `names` lists the names in order.
+    """
+    __slots__ = ('names', 'counters')
+
+    def __init__(self):
+        super().__init__()
+        self.names = []
+        self.counters = {}
+
+    def __missing__(self, name):
+        self[name] = n = len(self.names)
+        self.names.append(name)
+        return n
+
+    # Get the number for a name, adding it if it is new.
+    number = dict.__getitem__
+
+    def fresh(self, seed):
+        """Add a new name that starts with `seed` and return its number.
+        The suffixes count up from 1, as in `util.fresh`, but each seed
+        remembers where it left off.
+        """
+        i = self.counters.get(seed, 1)
+        while seed + str(i) in self:
+            i += 1
+        self.counters[seed] = i + 1
+        return self[seed + str(i)]
+
+
+class Instr:
+    """An instruction. `dest` is a variable number, `args` is a tuple of
+    variable numbers, and `labels` is a tuple of label numbers. Absent
+    fields are None.
+    """
+    __slots__ = ('op', 'dest', 'type', 'args', 'funcs', 'labels', 'value',
+                 'extra')
+
+    def __init__(self, op, dest=None, type=None, args=None, funcs=None,
+                 labels=None, value=None, extra=None):
+        self.op = op
+        self.dest = dest
+        self.type = type
+        self.args = args
+        self.funcs = funcs
+        self.labels = labels
+        self.value = value
+        self.extra = extra
+
+    def __repr__(self):
+        fields = ('{}={!r}'.format(slot, getattr(self, slot))
+                  for slot in self.__slots__
+                  if getattr(self, slot) is not None)
+        return 'Instr({})'.format(', '.join(fields))
+
+
+class Block:
+    """A basic block: an optional label number and a list of `Instr`s.
+    `extra` holds any keys on the label besides its name.
+    """
+    __slots__ = ('label', 'instrs', 'extra')
+
+    def __init__(self, label=None, instrs=None, extra=None):
+        self.label = label
+        self.instrs = [] if instrs is None else instrs
+        self.extra = extra
+
+
+class Function:
+    """A function, with its instructions split into `Block`s the way
+    `form_blocks` splits them. `args` is a list of (variable number,
+    type) pairs, and `vars` and `labels` are the `Names` tables for the
+    function's variables and labels.
+    """
+    __slots__ = ('name', 'args', 'type', 'blocks', 'vars', 'labels',
+                 'extra')
+
+    def __init__(self, name):
+        self.name = name
+        self.args = None
+        self.type = None
+        self.blocks = []
+        self.vars = Names()
+        self.labels = Names()
+        self.extra = None
+
+    def instrs(self):
+        """Generate all the instructions in the function, in order.
+        """
+        for block in self.blocks:
+            yield from block.instrs
+
+
+# The instruction keys that have their own slots in `Instr`.
+_SLOT_KEYS = frozenset(('op', 'dest', 'type', 'args', 'funcs', 'labels',
+                        'value'))
+
+
+def instr_from_json(instr, vars, labels):
+    """Convert an instruction dict to an `Instr`, numbering its names
+    in the `vars` and `labels` tables.
+    """
+    get = instr.get
+    op = get('op')
+    dest = get('dest')
+    args = get('args')
+    funcs = get('funcs')
+    lbls = get('labels')
+    fields = (
+        sys.intern(op) if type(op) is str else None,
+        vars.number(dest) if type(dest) is str else None,
+        get('type'),
+        tuple(map(vars.number, args)) if type(args) is list else None,
+        tuple(funcs) if type(funcs) is list else None,
+        tuple(map(labels.number, lbls)) if type(lbls) is list else None,
+        get('value'),
+    )
+    out = Instr(*fields)
+    if len(instr) != len(fields) - fields.count(None):
+        # Keep the keys that did not go into slots. (A slot is set
+        # exactly when its key went into it.)
+        out.extra = {k: v for k, v in instr.items()
+                     if k not in _SLOT_KEYS or getattr(out, k) is None}
+    return out
+
+
+def instr_to_json(instr, vars, labels):
+    """Convert an `Instr` back to a dict.
+    """
+    out = {}
+    if instr.op is not None:
+        out['op'] = instr.op
+    if instr.dest is not None:
+        out['dest'] = vars.names[instr.dest]
+    if instr.type is not None:
+        out['type'] = instr.type
+    if instr.args is not None:
+        out['args'] = list(map(vars.names.__getitem__, instr.args))
+    if instr.funcs is not None:
+        out['funcs'] = list(instr.funcs)
+    if instr.labels is not None:
+        out['labels'] = list(map(labels.names.__getitem__, instr.labels))
+    if instr.value is not None:
+        out['value'] = instr.value
+    if instr.extra:
+        out.update(instr.extra)
+    return out
+
+
+def from_json(func):
+    """Convert a function dict to a `Function`.
+    """
+    fn = Function(func['name'])
+    vars, labels = fn.vars, fn.labels
+    for key, value in func.items():
+        if key == 'args' and isinstance(value, list) and all(
+            isinstance(a, dict) and a.keys() == {'name', 'type'} and
+            isinstance(a['name'], str) for a in value
+        ):
+            fn.args = [(vars.number(a['name']), a['type']) for a in value]
+        elif key == 'type' and value is not None:
+            fn.type = value
+        elif key not in ('name', 'instrs'):
+            if fn.extra is None:
+                fn.extra = {}
+            fn.extra[key] = value
+
+    # Split the instructions into blocks like `form_blocks`: labels
+    # start blocks and terminators end them.
+    block = None
+    for instr in func['instrs']:
+        if 'op' in instr or 'label' not in instr:
+            if block is None:
+                block = Block()
+                fn.blocks.append(block)
+            block.instrs.append(instr_from_json(instr, vars, labels))
+            if instr.get('op') in TERMINATORS:
+                block = None
+        else:
+            extra = {k: v for k, v in instr.items() if k != 'label'}
+            block = Block(labels.number(instr['label']), extra=extra or None)
+            fn.blocks.append(block)
+    return fn
+
+
+def to_json(fn):
+    """Convert a `Function` back to a dict.
+    """
+    vars, labels = fn.vars, fn.labels
+    func = {'name': fn.name}
+    if fn.args is not None:
+        func['args'] = [{'name': vars.names[v], 'type': t}
+                        for v, t in fn.args]
+    if fn.type is not None:
+        func['type'] = fn.type
+    if fn.extra:
+        func.update(fn.extra)
+
+    instrs = func['instrs'] = []
+    for block in fn.blocks:
+        if block.label is not None:
+            label = {'label': labels.names[block.label]}
+            if block.extra:
+                label.update(block.extra)
+            instrs.append(label)
+        instrs.extend(instr_to_json(i, vars, labels) for i in block.instrs)
+    return func
+
+
+def apply(func_pass, func):
+    """Apply `func_pass`, which modifies a `Function` in place, to a
+    function dict, returning the new dict.
+    """
+    fn = from_json(func)
+    func_pass(fn)
+    return to_json(fn)
+
+
+def transform(bril, func_pass, names=None, jobs=1):
+    """Apply `func_pass`, which modifies a `Function` in place, to every
+    function in the program `bril` (or just the functions in `names`),
+    converting them to and from the JSON form. With more than one job,
+    run in parallel with `briltxt.map_funcs` (so `func_pass` must be
+    picklable).
+    """
+    briltxt.transform_funcs(bril, functools.partial(apply, func_pass),
+                            names, jobs)
@@ -1,14 +1,16 @@
-import json
 import sys
 
+import briltxt
+
 
 def is_ssa(bril):
     """Check whether a Bril program is in SSA form.
 
-    Every function in the program may assign to each variable once.
+    Every function in the program may assign to each variable once, and
+    not at all to its arguments.
     """
     for func in bril['functions']:
-        assigned = set()
+        assigned = {arg['name'] for arg in func.get('args', ())}
         for instr in func['instrs']:
             if 'dest' in instr:
                 if instr['dest'] in assigned:
@@ -19,4 +21,4 @@ def is_ssa(bril):
 
 
 if __name__ == '__main__':
-    print('yes' if is_ssa(json.load(sys.stdin)) else 'no')
+    print('yes' if is_ssa(briltxt.read_prog(sys.stdin)[0]) else 'no')
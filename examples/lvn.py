@@ -1,11 +1,17 @@
 """Local value numbering for Bril.
 """
-import json
+import functools
 import sys
 from collections import namedtuple
 
-from form_blocks import form_blocks
-from util import flatten
+import briltxt
+
+import ir
+from analysis import AnalysisManager
+from cfg import reassemble
+from graphs import tree_walk
+from is_ssa import is_ssa
+from to_ssa import func_to_ssa
 
 # A Value uniquely represents a computation in terms of sub-values.
 Value = namedtuple('Value', ['op', 'args'])
@@ -41,31 +47,32 @@ def last_writes(instrs):
     """
     out = [False] * len(instrs)
     seen = set()
-    for idx, instr in reversed(list(enumerate(instrs))):
-        if 'dest' in instr:
-            dest = instr['dest']
-            if dest not in seen:
-                out[idx] = True
-                seen.add(instr['dest'])
+    for idx in range(len(instrs) - 1, -1, -1):
+        dest = instrs[idx].dest
+        if dest is not None and dest not in seen:
+            out[idx] = True
+            seen.add(dest)
     return out
 
 
 def read_first(instrs):
-    """Given a block of instructions, return a set of variable names
+    """Given a block of instructions, return a set of variable numbers
     that are read before they are written.
     """
     read = set()
     written = set()
     for instr in instrs:
-        read.update(set(instr.get('args', [])) - written)
-        if 'dest' in instr:
-            written.add(instr['dest'])
+        if instr.args:
+            read.update(a for a in instr.args if a not in written)
+        if instr.dest is not None:
+            written.add(instr.dest)
     return read
 
 
-def lvn_block(block, lookup, canonicalize, fold):
-    """Use local value numbering to optimize a basic block. Modify the
-    instructions in place.
+def lvn_block(block, vars, lookup, canonicalize, fold):
+    """Use local value numbering to optimize a basic block (a list of
+    `ir.Instr`s). Modify the instructions in place. `vars` is the
+    function's variable table, for adding new variables.
 
     You can extend the basic LVN algorithm to bring interesting language
     semantics with these functions:
@@ -87,7 +94,7 @@ def lvn_block(block, lookup, canonicalize, fold):
     # can reuse it later.
     value2num = {}
 
-    # The *canonical* variable name holding a given numbered value.
+    # The *canonical* variable holding a given numbered value.
     # There is only one canonical variable per value number (so this is
     # not the inverse of var2num).
     num2var = {}
@@ -104,78 +111,72 @@ def lvn_block(block, lookup, canonicalize, fold):
     for instr, last_write in zip(block, last_writes(block)):
         # Look up the value numbers for all variable arguments,
         # generating new numbers for unseen variables.
-        argvars = instr.get('args', [])
-        argnums = tuple(var2num[var] for var in argvars)
+        argnums = tuple(var2num[var] for var in instr.args or ())
 
         # Non-call value operations are candidates for replacement. (We
         # could conceivably include calls to pure functions as values,
         # but determining purity would require an interprocedural
         # analysis.)
         val = None
-        if 'dest' in instr and 'args' in instr and instr['op'] != 'call':
+        if instr.dest is not None and instr.args is not None and \
+                instr.op != 'call':
             # Construct a Value for this computation.
-            val = canonicalize(Value(instr['op'], argnums))
+            val = canonicalize(Value(instr.op, argnums))
 
             # Is this value already available?
             num = lookup(value2num, val)
             if num is not None:
                 # Mark this variable as containing the value.
-                var2num[instr['dest']] = num
+                var2num[instr.dest] = num
 
                 # Replace the instruction with a copy or a constant.
                 if num in num2const:  # Value is a constant.
-                    instr.update({
-                        'op': 'const',
-                        'value': num2const[num],
-                    })
-                    del instr['args']
+                    instr.op = 'const'
+                    instr.value = num2const[num]
+                    instr.args = None
                 else:  # Value is in a variable.
-                    instr.update({
-                        'op': 'id',
-                        'args': [num2var[num]],
-                    })
+                    instr.op = 'id'
+                    instr.args = (num2var[num],)
                 continue
 
         # If this instruction produces a result, give it a number.
-        if 'dest' in instr:
-            newnum = var2num.add(instr['dest'])
+        if instr.dest is not None:
+            newnum = var2num.add(instr.dest)
 
             # Record constant values.
-            if instr['op'] == 'const':
-                num2const[newnum] = instr['value']
+            if instr.op == 'const':
+                num2const[newnum] = instr.value
 
             if last_write:
                 # Preserve the variable name for other blocks.
-                var = instr['dest']
+                var = instr.dest
             else:
                 # We must put the value in a new variable so it can be
                 # reused by another computation in the feature (in case
                 # the current variable name is reassigned before then).
-                var = 'lvn.{}'.format(newnum)
+                var = vars.number('lvn.{}'.format(newnum))
 
-            # Record the variable name and update the instruction.
+            # Record the variable and update the instruction.
             num2var[newnum] = var
-            instr['dest'] = var
+            instr.dest = var
 
             if val:
                 # Is this value foldable to a constant?
                 const = fold(num2const, val)
                 if const:
                     num2const[newnum] = const
-                    instr.update({
-                        'op': 'const',
-                        'value': const,
-                    })
-                    del instr['args']
+                    instr.op = 'const'
+                    instr.value = const
+                    instr.args = None
                     continue
 
                 # If not, record the new variable as the canonical
                 # source for the newly computed value.
                 value2num[val] = newnum
 
-        # Update argument variable names to canonical variables.
-        if 'args' in instr:
-            instr['args'] = [num2var[n] for n in argnums]
+        # Update argument variables to canonical variables.
+        if instr.args is not None:
+            instr.args = tuple(num2var[n] for n in argnums)
 
 
 def _lookup(value2num, value):
@@ -187,11 +188,17 @@ def _lookup(value2num, value):
         return value2num.get(value)
 
 
+def _div(a, b):
+    # Bril division truncates toward zero.
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+
 FOLDABLE_OPS = {
     'add': lambda a, b: a + b,
     'mul': lambda a, b: a * b,
     'sub': lambda a, b: a - b,
-    'div': lambda a, b: a // b,
+    'div': lambda a, b: _div(a, b),
     'gt': lambda a, b: a > b,
     'lt': lambda a, b: a < b,
     'ge': lambda a, b: a >= b,
@@ -221,23 +228,222 @@ def _canonicalize(value):
         return value
 
 
-def lvn(bril, prop=False, canon=False, fold=False):
+def _hooks(prop, canon, fold):
+    """Get the `lookup`, `canonicalize`, and `fold` functions (see
+    `lvn_block`) for the chosen extensions.
+    """
+    return (
+        _lookup if prop else lambda v2n, v: v2n.get(v),
+        _canonicalize if canon else lambda v: v,
+        _fold if fold else lambda n2c, v: None,
+    )
+
+
+def lvn_func(func, prop=False, canon=False, fold=False):
     """Apply the local value numbering optimization to every basic block
-    in every function.
+    in an `ir.Function`.
     """
-    for func in bril['functions']:
-        blocks = list(form_blocks(func['instrs']))
-        for block in blocks:
-            lvn_block(
-                block,
-                lookup=_lookup if prop else lambda v2n, v: v2n.get(v),
-                canonicalize=_canonicalize if canon else lambda v: v,
-                fold=_fold if fold else lambda n2c, v: None,
-            )
-        func['instrs'] = flatten(blocks)
+    lookup, canonicalize, fold = _hooks(prop, canon, fold)
+    for block in func.blocks:
+        lvn_block(block.instrs, func.vars, lookup, canonicalize, fold)
+
+
+# Operations that cannot be reused even when their arguments match:
+# each `alloc` makes a new allocation, and a `load` can see a `store`
+# in between.
+IMPURE_OPS = frozenset(('call', 'alloc', 'load'))
+
+
+def gvn_func(func, am=None, prop=False, canon=False, fold=False):
+    """Apply global value numbering to a function dict, converting it to
+    SSA form first if it is not already. Get the CFG and dominator tree
+    from the `AnalysisManager` `am`, if there is one.
+
+    This is `lvn_block` stretched over the dominator tree: every SSA
+    variable has one value for the whole function, and a value computed
+    in a block can be reused in all the blocks it dominates. The table
+    of available values is scoped, so each block's values are forgotten
+    again when the walk leaves its subtree. The `lookup`,
+    `canonicalize`, and `fold` extensions are the same.
+    """
+    am = am or AnalysisManager()
+    if not is_ssa({'functions': [func]}):
+        func_to_ssa(func, am)
+    graph = am.get(func, 'cfg')
+    dominance = am.get(func, 'dominance')
+    if dominance.root is None:
+        return func  # No blocks.
+    lookup, canonicalize, fold = _hooks(prop, canon, fold)
+
+    # The tables are as in `lvn_block`, but for the whole function.
+    # In SSA form, the canonical variable of a value dominates every
+    # later computation of it.
+    var2num = Numbering()
+    value2num = {}
+    num2var = {}
+    num2const = {}
+
+    def number(var):
+        # Function arguments, undefined variables, and variables defined
+        # later (by back edges into phi-nodes) get their own numbers.
+        if var not in var2num:
+            num2var[var2num.add(var)] = var
+        return var2num[var]
+
+    def replace(instr, num):
+        # Get a copy or a constant for an available value.
+        if num in num2const:
+            return {'op': 'const', 'dest': instr['dest'],
+                    'type': instr['type'], 'value': num2const[num]}
+        return {'op': 'id', 'dest': instr['dest'], 'type': instr['type'],
+                'args': [num2var[num]]}
+
+    for arg in func.get('args', ()):
+        number(arg['name'])
+
+    # The values each block added to `value2num`, to remove on the way
+    # back up the tree.
+    scopes = {}
+    for node, entering in tree_walk(dominance.children, dominance.root):
+        if not entering:
+            for val in scopes.pop(node):
+                del value2num[val]
+            continue
+        scope = scopes[node] = []
+        block = graph.blocks[node]
+
+        phis = []
+        copies = []
+        rest = []
+        phi2num = {}  # Phi-nodes are only equal in the same block.
+        # Bril runs phi-nodes one after another, so an argument naming a
+        # phi-node that has not run yet reads its old value, and one
+        # naming a phi-node that has run reads its new value.
+        pending = {i['dest'] for i in block if i.get('op') == 'phi'}
+        copied = set()
+        for instr in block:
+            op = instr.get('op')
+            dest = instr.get('dest')
+            if op == 'phi':
+                # Redundant phi-nodes become copies after the others, so
+                # read their values instead.
+                instr['args'] = [num2var[var2num[a]] if a in copied else a
+                                 for a in instr['args']]
+            argnums = tuple(number(a) for a in instr.get('args', ()))
+
+            if op == 'phi':
+                # A phi-node is redundant if all its arguments (besides
+                # itself) have the same value, or if another phi-node in
+                # the block has the same arguments. Its copy comes after
+                # the phi-nodes, so it cannot read one that runs later.
+                nums = {n for a, n in zip(instr['args'], argnums)
+                        if a != dest}
+                val = Value('phi', tuple(sorted(zip(instr['labels'],
+                                                    argnums))))
+                num = nums.pop() if len(nums) == 1 else phi2num.get(val)
+                pending.discard(dest)
+                if num is not None and num2var[num] not in pending:
+                    var2num[dest] = num
+                    copied.add(dest)
+                    copies.append(replace(instr, num))
+                else:
+                    num = phi2num[val] = var2num.add(dest)
+                    num2var[num] = dest
+                    phis.append(instr)
+                continue
+
+            if op == 'const' and dest is not None:
+                # Equal constants share a number, so later computations
+                # on them match.
+                val = Value('const', (instr.get('type'), instr['value']))
+                num = value2num.get(val)
+                if num is None:
+                    num = value2num[val] = var2num.add(dest)
+                    num2var[num] = dest
+                    num2const[num] = instr['value']
+                    scope.append(val)
+                else:
+                    var2num[dest] = num
+                rest.append(instr)
+                continue
+
+            val = None
+            if dest is not None and 'args' in instr and \
+                    op not in IMPURE_OPS:
+                val = canonicalize(Value(op, argnums))
+                num = lookup(value2num, val)
+                if num is not None:
+                    var2num[dest] = num
+                    rest.append(replace(instr, num))
+                    continue
+
+            if dest is not None:
+                newnum = var2num.add(dest)
+                num2var[newnum] = dest
+                if val:
+                    value2num[val] = newnum
+                    scope.append(val)
+                    const = fold(num2const, val)
+                    if const is not None:
+                        num2const[newnum] = const
+                        rest.append(replace(instr, newnum))
+                        continue
+
+            # Use the canonical variables for the arguments.
+            if 'args' in instr:
+                instr['args'] = [num2var[n] for n in argnums]
+            rest.append(instr)
+
+        # Keep the phi-nodes at the top of the block.
+        block[:] = phis + copies + rest
+
+        # Use the canonical variables in the successors' phi-nodes too,
+        # unless that is one of their phi-nodes, which may already hold
+        # its new value.
+        name = graph.names[node]
+        for succ in graph.succs(node):
+            succ_phis = [i for i in graph.blocks[succ] if i.get('op') == 'phi']
+            dests = {i['dest'] for i in succ_phis}
+            for instr in succ_phis:
+                for i, label in enumerate(instr['labels']):
+                    if label == name:
+                        var = num2var[number(instr['args'][i])]
+                        if var not in dests:
+                            instr['args'][i] = var
+
+    func['instrs'] = reassemble(graph.block_map())
+    am.invalidate(func['name'])
+    return func
+
+
+def lvn(bril, prop=False, canon=False, fold=False, names=None, jobs=1):
+    """Apply the local value numbering optimization to every basic block
+    in every function (or just the functions in `names`), using `jobs`
+    worker processes.
+    """
+    ir.transform(bril, functools.partial(lvn_func, prop=prop, canon=canon,
+                                         fold=fold),
+                 names, jobs)
+
+
+def gvn(bril, prop=False, canon=False, fold=False, names=None, jobs=1):
+    """Apply global value numbering to every function (or just the
+    functions in `names`), using `jobs` worker processes. Produce the
+    new program, in SSA form.
+    """
+    return briltxt.transform_funcs(
+        bril,
+        functools.partial(gvn_func, prop=prop, canon=canon, fold=fold),
+        names, jobs,
+    )
 
 
 if __name__ == '__main__':
-    bril = json.load(sys.stdin)
-    lvn(bril, '-p' in sys.argv, '-c' in sys.argv, '-f' in sys.argv)
-    json.dump(bril, sys.stdout, indent=2, sort_keys=True)
+    bril, binary = briltxt.read_prog(sys.stdin, lazy=True)
+    flags = ('-p' in sys.argv, '-c' in sys.argv, '-f' in sys.argv,
+             briltxt.func_names(sys.argv[1:]), briltxt.jobs_arg(sys.argv[1:]))
+    if '-g' in sys.argv:
+        bril = gvn(bril, *flags)
+    else:
+        lvn(bril, *flags)
+    briltxt.write_prog(bril, sys.stdout, binary)
@@ -0,0 +1,235 @@
+"""Run a pipeline of optimization passes on a Bril program in a single
+process, so the program is parsed and serialized only once.
+
+Each argument names a pass, optionally followed by its flags:
+
+    bril2json < prog.bril | python pipeline.py tdce+ to_ssa 'lvn -p -c -f'
+
+Passes share analyses (the CFG, dominators, and so on) through an
+`analysis.AnalysisManager`, and each pass declares which analyses it
+preserves. With `--time`, print the wall-clock time for each stage to
+stderr, along with how many analyses were computed and reused. With
+`--jobs N`, the functions are split among N worker processes, each of
+which runs the whole pipeline on its share.
+"""
+import functools
+import importlib
+import os
+import shlex
+import sys
+import time
+from collections import namedtuple
+
+import briltxt
+
+import ir
+import lvn
+from analysis import AnalysisManager, CFG_SHAPE
+import tdce
+import dce
+import to_ssa
+import from_ssa
+import sccp
+import adce
+
+# A registered pass:
+# - kind: What `run` transforms. 'ir' passes modify an `ir.Function`
+#   in place; 'func' passes take a function dict and return the new
+#   function dict (which may be the same one).
+# - run: The transformation, given a function, the pass's flags, and an
+#   `AnalysisManager` to get analyses from.
+# - preserves: The analyses that are still valid after the pass.
+Pass = namedtuple('Pass', ['kind', 'run', 'preserves'])
+
+
+def _import(dirname, name):
+    """Import a module that lives in another directory of the
+    repository. The directory goes at the *end* of the path so that the
+    modules here (`cfg`, `form_blocks`, ...) keep priority over the
+    copies in lesson directories.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        dirname)
+    if path not in sys.path:
+        sys.path.append(path)
+    return importlib.import_module(name)
+
+
+def _tdce(mode):
+    # Deleting instructions can empty out an anonymous block, which then
+    # disappears, so not even the CFG's shape is preserved.
+    def run(func, flags, am):
+        tdce.MODES[mode](func)
+    return Pass('ir', run, ())
+
+
+def _lvn(func, flags, am):
+    lvn.lvn_func(func, '-p' in flags, '-c' in flags, '-f' in flags)
+
+
+def _gvn(func, flags, am):
+    return lvn.gvn_func(func, am, '-p' in flags, '-c' in flags, '-f' in flags)
+
+
+def _dce(func, flags, am):
+    return dce.live_dce(func)
+
+
+def _to_ssa(func, flags, am):
+    to_ssa.func_to_ssa(func, am)
+    return func
+
+
+def _from_ssa(func, flags, am):
+    from_ssa.func_from_ssa(func, am)
+    return func
+
+
+def _sccp(func, flags, am):
+    return sccp.func_sccp(func, am)
+
+
+def _adce(func, flags, am):
+    return adce.func_adce(func, am)
+
+
+def _licm(func, flags, am):
+    return _import('eba33_lesson7', 'licm').licm(func)
+
+
+def _infer(func, flags, am):
+    infer = _import('type-infer', 'infer')
+    typed = infer.infer_types_func(func)
+    if '-t' in flags:
+        infer.typecheck_func(func, typed)
+    return typed
+
+
+PASSES = {
+    'tdce': _tdce('tdce'),
+    'tdcep': _tdce('tdcep'),
+    'dkp': _tdce('dkp'),
+    'tdce+': _tdce('tdce+'),
+    'wdce': _tdce('wdce'),
+    'lvn': Pass('ir', _lvn, CFG_SHAPE),
+    'gvn': Pass('func', _gvn, ()),
+    'dce': Pass('func', _dce, ()),
+    'to_ssa': Pass('func', _to_ssa, ()),
+    'from_ssa': Pass('func', _from_ssa, ()),
+    'sccp': Pass('func', _sccp, ()),
+    'adce': Pass('func', _adce, ()),
+    'licm': Pass('func', _licm, ()),
+    # Inference only adds types.
+    'infer': Pass('func', _infer, CFG_SHAPE | {'live', 'live_instrs'}),
+}
+
+
+def parse_pipeline(specs):
+    """Parse pass specifications like `'lvn -p -c'` into a list of
+    (name, flags) pairs.
+    """
+    pipeline = []
+    for spec in specs:
+        name, *flags = shlex.split(spec)
+        if name not in PASSES:
+            raise ValueError('unknown pass {}; choose from {}'.format(
+                name, ', '.join(PASSES),
+            ))
+        pipeline.append((name, flags))
+    return pipeline
+
+
+def run_pipeline(bril, pipeline, timings=None, am=None):
+    """Run the (name, flags) passes in `pipeline` on every function in
+    `bril`, modifying it in place. Functions are converted to and from
+    the `ir` representation only when the kind of pass changes, and
+    analyses are shared between passes through the `AnalysisManager`
+    `am`. If `timings` is a list, append a (name, seconds) pair for each
+    pass.
+    """
+    am = am or AnalysisManager()
+    funcs = bril['functions']
+    for name, flags in pipeline:
+        start = time.perf_counter()
+        p = PASSES[name]
+        for i, func in enumerate(funcs):
+            if p.kind == 'ir':
+                if not isinstance(func, ir.Function):
+                    func = funcs[i] = ir.from_json(func)
+                p.run(func, flags, am)
+                am.invalidate(func.name, p.preserves)
+            else:
+                if isinstance(func, ir.Function):
+                    func = ir.to_json(func)
+                funcs[i] = p.run(func, flags, am)
+                am.invalidate(funcs[i]['name'], p.preserves)
+        if timings is not None:
+            timings.append((' '.join([name] + flags),
+                            time.perf_counter() - start))
+
+    # Convert any leftover IR functions back.
+    for i, func in enumerate(funcs):
+        if isinstance(func, ir.Function):
+            funcs[i] = ir.to_json(func)
+    return bril
+
+
+def run_func(pipeline, func):
+    """Run a pipeline on a single function dict and return the result.
+    """
+    bril = {'functions': [func]}
+    run_pipeline(bril, pipeline)
+    return bril['functions'][0]
+
+
+def pipeline_main(argv):
+    timed = '--time' in argv
+    jobs = briltxt.jobs_arg(argv)
+    specs = []
+    for arg, prev in zip(argv, [None] + argv):
+        if arg != '--time' and not arg.startswith('--jobs') and \
+                prev != '--jobs':
+            specs.append(arg)
+    try:
+        pipeline = parse_pipeline(specs)
+    except ValueError as exc:
+        sys.exit(str(exc))
+
+    timings = []
+    start = time.perf_counter()
+    bril, binary = briltxt.read_prog(sys.stdin)
+    timings.append(('(read)', time.perf_counter() - start))
+
+    am = AnalysisManager()
+    if jobs > 1:
+        # Each worker runs the whole pipeline on its functions, so we
+        # can only time the pipeline as a whole.
+        start = time.perf_counter()
+        bril['functions'] = briltxt.map_funcs(
+            functools.partial(run_func, pipeline), bril['functions'], jobs,
+        )
+        timings.append(('(all passes, {} jobs)'.format(jobs),
+                        time.perf_counter() - start))
+    else:
+        run_pipeline(bril, pipeline, timings, am)
+
+    start = time.perf_counter()
+    briltxt.write_prog(bril, sys.stdout, binary)
+    timings.append(('(write)', time.perf_counter() - start))
+
+    if timed:
+        width = max(len(name) for name, _ in timings)
+        for name, secs in timings:
+            print('{:<{}}  {:8.2f} ms'.format(name, width, secs * 1000),
+                  file=sys.stderr)
+        print('{:<{}}  {:8.2f} ms'.format(
+            'total', width, sum(secs for _, secs in timings) * 1000,
+        ), file=sys.stderr)
+        if jobs <= 1:
+            print('analyses: {} computed, {} reused'.format(
+                am.misses, am.hits,
+            ), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    pipeline_main(sys.argv[1:])
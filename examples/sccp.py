@@ -0,0 +1,292 @@
+"""Sparse conditional constant propagation (Wegman and Zadeck).
+
+Functions are converted to SSA form first (unless they already are),
+and stay in SSA form. Every variable starts out with no known value
+("top") and can only move down to a constant and then to "not a
+constant". The solver follows two worklists: CFG edges that just became
+executable, and variables whose values just changed, which are followed
+along def-use edges to the instructions that read them. Blocks are only
+evaluated once an edge into them is known to execute, and a branch on a
+constant only makes one of its edges executable.
+
+Then the function is rewritten: instructions (and phi-nodes) with
+constant results become `const`s, branches on constants become jumps,
+and blocks that can never execute are deleted. A later dead code pass
+can remove the computations that are no longer used.
+
+    bril2json < prog.bril | python sccp.py | python tdce.py tdce+
+"""
+
+import math
+import operator
+import sys
+from collections import defaultdict
+
+import briltxt
+
+from analysis import AnalysisManager
+from cfg import reassemble
+from is_ssa import is_ssa
+from to_ssa import func_to_ssa
+
+# The bottom of the lattice: a variable that is not a constant. (The
+# top, a variable with no value yet, is just a missing entry.)
+NAC = object()
+
+
+def _wrap(n):
+    """Wrap an integer to 64-bit two's complement, like Bril's ints.
+    """
+    n &= (1 << 64) - 1
+    return n - (1 << 64) if n >> 63 else n
+
+
+def _int(op):
+    return lambda a, b: _wrap(op(a, b))
+
+
+def _div(a, b):
+    # Bril division truncates toward zero.
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+
+# How to evaluate each pure operation on constant arguments. Operations
+# that fail (dividing by zero, say) are left alone.
+OPS = {
+    'id': lambda a: a,
+    'add': _int(operator.add),
+    'sub': _int(operator.sub),
+    'mul': _int(operator.mul),
+    'div': _int(_div),
+    'eq': operator.eq,
+    'lt': operator.lt,
+    'gt': operator.gt,
+    'le': operator.le,
+    'ge': operator.ge,
+    'not': operator.not_,
+    'and': lambda a, b: a and b,
+    'or': lambda a, b: a or b,
+    'fadd': operator.add,
+    'fsub': operator.sub,
+    'fmul': operator.mul,
+    'fdiv': operator.truediv,
+    'feq': operator.eq,
+    'flt': operator.lt,
+    'fgt': operator.gt,
+    'fle': operator.le,
+    'fge': operator.ge,
+    'ceq': operator.eq,
+    'clt': operator.lt,
+    'cgt': operator.gt,
+    'cle': operator.le,
+    'cge': operator.ge,
+    'char2int': ord,
+    'int2char': chr,
+}
+
+
+def const_value(instr):
+    """Get the value of a `const` instruction as a Python value of the
+    right type.
+    """
+    value = instr['value']
+    return float(value) if instr.get('type') == 'float' else value
+
+
+def same(a, b):
+    """Are two lattice values the same? (Unlike `==`, this tells `1`
+    from `True` and `1.0`.)
+    """
+    return a is b or (type(a) is type(b) and a == b)
+
+
+def meet(a, b):
+    if a is None:
+        return b
+    if b is None or same(a, b):
+        return a
+    return NAC
+
+
+def evaluate(op, args):
+    """Evaluate a pure operation on lattice values: None (no value
+    yet), a constant, or `NAC`.
+    """
+    # `and` and `or` can be decided by one constant argument.
+    if op in ('and', 'or') and any(same(a, op == 'or') for a in args):
+        return op == 'or'
+    if any(a is NAC for a in args):
+        return NAC
+    if any(a is None for a in args):
+        return None
+    try:
+        value = OPS[op](*args)
+    except (ArithmeticError, TypeError, ValueError):
+        return NAC
+    if isinstance(value, float) and not math.isfinite(value):
+        return NAC  # Not representable as a constant.
+    return value
+
+
+class SCCP:
+    """Solve for the constant value of every variable in an SSA-form
+    function, given its `cfg.CFG`. `values` maps variables to constants
+    or `NAC`, `executable` marks the block ids that can execute, and
+    `edges` is the set of (source, destination) block id pairs that can.
+    """
+    def __init__(self, graph, args=()):
+        self.graph = graph
+        self.values = {arg: NAC for arg in args}
+        self.executable = bytearray(len(graph))
+        self.edges = set()
+
+        # Find the definitions and uses of each variable.
+        self.defined = set(args)
+        self.uses = defaultdict(list)
+        for node, block in enumerate(graph.blocks):
+            for instr in block:
+                if 'dest' in instr:
+                    self.defined.add(instr['dest'])
+                for arg in instr.get('args', ()):
+                    self.uses[arg].append((node, instr))
+
+        self.flow_work = [(-1, 0)]  # An edge into the entry.
+        self.ssa_work = []
+        self._solve()
+
+    def value(self, var):
+        # Variables without definitions could hold anything.
+        return self.values.get(var) if var in self.defined else NAC
+
+    def _solve(self):
+        graph = self.graph
+        while True:
+            while self.flow_work or self.ssa_work:
+                while self.flow_work:
+                    edge = self.flow_work.pop()
+                    if edge in self.edges:
+                        continue
+                    self.edges.add(edge)
+                    node = edge[1]
+                    if self.executable[node]:
+                        # Only the phi-nodes see the new edge.
+                        for instr in graph.blocks[node]:
+                            if instr.get('op') == 'phi':
+                                self._visit(node, instr)
+                    else:
+                        self.executable[node] = 1
+                        for instr in graph.blocks[node]:
+                            self._visit(node, instr)
+
+                while self.ssa_work:
+                    var = self.ssa_work.pop()
+                    for node, instr in self.uses[var]:
+                        if self.executable[node]:
+                            self._visit(node, instr)
+
+            # A branch on a variable that never got a value would
+            # strand its successors, so give up on such variables.
+            stuck = [block[-1]['args'][0]
+                     for node, block in enumerate(graph.blocks)
+                     if self.executable[node] and block[-1]['op'] == 'br'
+                     and self.value(block[-1]['args'][0]) is None]
+            if not stuck:
+                break
+            for var in stuck:
+                self.values[var] = NAC
+                self.ssa_work.append(var)
+
+    def _visit(self, node, instr):
+        graph = self.graph
+        op = instr.get('op')
+        if op == 'jmp':
+            self.flow_work.append((node, graph.index[instr['labels'][0]]))
+        elif op == 'br':
+            cond = self.value(instr['args'][0])
+            if cond is None:
+                return
+            for i, label in enumerate(instr['labels']):
+                if cond is NAC or cond == (i == 0):
+                    self.flow_work.append((node, graph.index[label]))
+        elif 'dest' in instr:
+            if op == 'phi':
+                new = None
+                for label, arg in zip(instr['labels'], instr['args']):
+                    if (graph.index[label], node) in self.edges:
+                        new = meet(new, self.value(arg))
+            elif op == 'const':
+                new = const_value(instr)
+            elif op in OPS:
+                new = evaluate(op, [self.value(a) for a in instr['args']])
+            else:
+                new = NAC  # Calls, memory, and so on.
+
+            dest = instr['dest']
+            old = self.values.get(dest)
+            new = meet(old, new)  # Values only ever go down.
+            if old is None and new is not None or \
+                    old is not None and not same(old, new):
+                self.values[dest] = new
+                self.ssa_work.append(dest)
+
+
+def func_sccp(func, am=None):
+    """Propagate constants through a function dict, converting it to SSA
+    form first if it is not already. Get the CFG from the
+    `AnalysisManager` `am`, if there is one.
+    """
+    am = am or AnalysisManager()
+    if not is_ssa({'functions': [func]}):
+        func_to_ssa(func, am)
+    graph = am.get(func, 'cfg')
+    solver = SCCP(graph, [a['name'] for a in func.get('args', ())])
+    values, edges = solver.values, solver.edges
+
+    blocks = {}
+    for node, (name, block) in enumerate(zip(graph.names, graph.blocks)):
+        if not solver.executable[node]:
+            continue  # Unreachable.
+        blocks[name] = block
+        for i, instr in enumerate(block):
+            op = instr.get('op')
+            if op == 'phi':
+                # Drop the arguments from edges that never execute.
+                pairs = [(label, arg)
+                         for label, arg in zip(instr['labels'], instr['args'])
+                         if (graph.index[label], node) in edges]
+                instr['labels'] = [label for label, _ in pairs]
+                instr['args'] = [arg for _, arg in pairs]
+                if len(pairs) == 1:
+                    block[i] = instr = {'op': 'id', 'dest': instr['dest'],
+                                        'type': instr['type'],
+                                        'args': instr['args']}
+                    op = 'id'
+
+            value = values.get(instr.get('dest'))
+            if op not in (None, 'const', 'call') and value is not None and \
+                    value is not NAC:
+                block[i] = {'op': 'const', 'dest': instr['dest'],
+                            'type': instr['type'], 'value': value}
+            elif op == 'br':
+                cond = values.get(instr['args'][0])
+                if cond is not NAC and cond is not None:
+                    block[i] = {'op': 'jmp',
+                                'labels': [instr['labels'][0 if cond else 1]]}
+
+    func['instrs'] = reassemble(blocks)
+    am.invalidate(func['name'])
+    return func
+
+
+def sccp(bril, names=None, jobs=1):
+    return briltxt.transform_funcs(bril, func_sccp, names, jobs)
+
+
+if __name__ == '__main__':
+    bril, binary = briltxt.read_prog(sys.stdin, lazy=True)
+    args = sys.argv[1:]
+    briltxt.write_prog(
+        sccp(bril, briltxt.func_names(args), briltxt.jobs_arg(args)),
+        sys.stdout, binary,
+    )
@@ -3,44 +3,39 @@ local optimization.
 """
 
 import sys
-import json
-from form_blocks import form_blocks
-from util import flatten
+import briltxt
+import ir
 
 
 def trivial_dce_pass(func):
-    """Remove instructions from `func` that are never used as arguments
-    to any other instruction. Return a bool indicating whether we deleted
-    anything.
+    """Remove instructions from `func` (an `ir.Function`) that are never
+    used as arguments to any other instruction. Return a bool indicating
+    whether we deleted anything.
     """
-    blocks = list(form_blocks(func['instrs']))
-
     # Find all the variables used as an argument to any instruction,
     # even once.
     used = set()
-    for block in blocks:
-        for instr in block:
+    for block in func.blocks:
+        for instr in block.instrs:
             # Mark all the variable arguments as used.
-            used.update(instr.get('args', []))
+            if instr.args:
+                used.update(instr.args)
 
     # Delete the instructions that write to unused variables.
     changed = False
-    for block in blocks:
+    for block in func.blocks:
         # Avoid deleting *effect instructions* that do not produce a
-        # result. The `'dest' in i` predicate is true for all the *value
-        # functions*, which are pure and can be eliminated if their
-        # results are never used.
-        new_block = [i for i in block
-                     if 'dest' not in i or i['dest'] in used]
+        # result. The `i.dest is None` predicate is false for all the
+        # *value functions*, which are pure and can be eliminated if
+        # their results are never used.
+        new_instrs = [i for i in block.instrs
+                      if i.dest is None or i.dest in used]
 
         # Record whether we deleted anything.
-        changed |= len(new_block) != len(block)
-
-        # Replace the block with the filtered one.
-        block[:] = new_block
+        changed |= len(new_instrs) != len(block.instrs)
 
-    # Reassemble the function.
-    func['instrs'] = flatten(blocks)
+        # Replace the block's instructions with the filtered ones.
+        block.instrs = new_instrs
 
     return changed
 
@@ -55,11 +50,11 @@ def trivial_dce(func):
 
 
 def drop_killed_local(block):
-    """Delete instructions in a single block whose result is unused
-    before the next assignment. Return a bool indicating whether
-    anything changed.
+    """Delete instructions in a single block (an `ir.Block`) whose
+    result is unused before the next assignment. Return a bool
+    indicating whether anything changed.
     """
-    # A map from variable names to the last place they were assigned
+    # A map from variable numbers to the last place they were assigned
     # since the last use. These are candidates for deletion---if a
     # variable is assigned while in this map, we'll delete what the maps
     # point to.
@@ -67,18 +62,19 @@ def drop_killed_local(block):
 
     # Find the indices of droppable instructions.
     to_drop = set()
-    for i, instr in enumerate(block):
+    for i, instr in enumerate(block.instrs):
         # Check for uses. Anything we use is no longer a candidate for
         # deletion.
-        for var in instr.get('args', []):
-            if var in last_def:
-                del last_def[var]
+        if instr.args:
+            for var in instr.args:
+                if var in last_def:
+                    del last_def[var]
 
         # Check for definitions. This *has* to happen after the use
         # check, so we don't count "a = a + 1" as killing a before using
         # it.
-        if 'dest' in instr:
-            dest = instr['dest']
+        dest = instr.dest
+        if dest is not None:
             if dest in last_def:
                 # Another definition since the most recent use. Drop the
                 # last definition.
@@ -86,22 +82,20 @@ def drop_killed_local(block):
             last_def[dest] = i
 
     # Remove the instructions marked for deletion.
-    new_block = [instr for i, instr in enumerate(block)
-                 if i not in to_drop]
-    changed = len(new_block) != len(block)
-    block[:] = new_block
-    return changed
+    if not to_drop:
+        return False
+    block.instrs = [instr for i, instr in enumerate(block.instrs)
+                    if i not in to_drop]
+    return True
 
 
 def drop_killed_pass(func):
     """Drop killed functions from *all* blocks. Return a bool indicating
     whether anything changed.
     """
-    blocks = list(form_blocks(func['instrs']))
     changed = False
-    for block in blocks:
+    for block in func.blocks:
         changed |= drop_killed_local(block)
-    func['instrs'] = flatten(blocks)
     return changed
 
 
@@ -112,25 +106,105 @@ def trivial_dce_plus(func):
         pass
 
 
+def worklist_dce(func):
+    """Delete the same instructions as `trivial_dce_plus`, but in time
+    linear in the size of the function.
+
+    Instead of searching the whole function again after every change, we
+    count the uses of each variable once. Each use also counts toward
+    the latest definition of its variable earlier in the same block, if
+    any. A definition is dead when its variable has no uses left, or
+    when it is followed by another definition in its block and none of
+    its local uses are left. Deleting a dead instruction takes away its
+    uses, which can make more definitions dead, so we keep a worklist.
+    """
+    n = len(func.vars.names)
+    uses = [0] * n  # Uses of each variable.
+    defs = [[] for _ in range(n)]  # Ids of each variable's definitions.
+
+    # Give each instruction an id. For each one, record the id of the
+    # definition that each argument reads in the same block (or -1), the
+    # number of uses of its own result before the next definition in its
+    # block, and whether there is a next definition at all.
+    instrs = []
+    reads = []
+    local_uses = []
+    killed = bytearray()
+    for block in func.blocks:
+        last_def = {}
+        for instr in block.instrs:
+            k = len(instrs)
+            instrs.append(instr)
+            local_uses.append(0)
+            killed.append(0)
+
+            read = []
+            for var in instr.args or ():
+                uses[var] += 1
+                d = last_def.get(var, -1)
+                if d != -1:
+                    local_uses[d] += 1
+                read.append(d)
+            reads.append(read)
+
+            dest = instr.dest
+            if dest is not None:
+                defs[dest].append(k)
+                if dest in last_def:
+                    killed[last_def[dest]] = 1
+                last_def[dest] = k
+
+    work = [k for k, instr in enumerate(instrs) if instr.dest is not None
+            and (not uses[instr.dest] or killed[k] and not local_uses[k])]
+    dead = bytearray(len(instrs))
+    while work:
+        k = work.pop()
+        if dead[k]:
+            continue
+        dead[k] = 1
+
+        # Take away the instruction's uses.
+        for var, d in zip(instrs[k].args or (), reads[k]):
+            uses[var] -= 1
+            if not uses[var]:
+                work += defs[var]
+            if d != -1:
+                local_uses[d] -= 1
+                if killed[d] and not local_uses[d]:
+                    work.append(d)
+
+    # Delete the dead instructions, block by block.
+    k = 0
+    for block in func.blocks:
+        count = len(block.instrs)
+        if any(dead[k:k + count]):
+            block.instrs = [instr for instr, d
+                            in zip(block.instrs, dead[k:k + count]) if not d]
+        k += count
+
+
 MODES = {
     'tdce': trivial_dce,
     'tdcep': trivial_dce_pass,
     'dkp': drop_killed_pass,
     'tdce+': trivial_dce_plus,
+    'wdce': worklist_dce,
 }
 
 
 def localopt():
-    if len(sys.argv) > 1:
-        modify_func = MODES[sys.argv[1]]
+    modes = [arg for arg in sys.argv[1:] if arg in MODES]
+    if modes:
+        modify_func = MODES[modes[0]]
     else:
         modify_func = trivial_dce
 
-    # Apply the change to all the functions in the input program.
-    bril = json.load(sys.stdin)
-    for func in bril['functions']:
-        modify_func(func)
-    json.dump(bril, sys.stdout, indent=2, sort_keys=True)
+    # Apply the change to all the functions in the input program (or
+    # the ones selected with `--func`), with `--jobs` processes.
+    bril, binary = briltxt.read_prog(sys.stdin, lazy=True)
+    ir.transform(bril, modify_func, briltxt.func_names(sys.argv[1:]),
+                 briltxt.jobs_arg(sys.argv[1:]))
+    briltxt.write_prog(bril, sys.stdout, binary)
 
 
 if __name__ == '__main__':
@@ -1,10 +1,12 @@
-import json
 import sys
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 
-from cfg import block_map, successors, add_terminators, add_entry, reassemble
-from form_blocks import form_blocks
-from dom import get_dom, dom_fronts, dom_tree, map_inv
+import briltxt
+
+from analysis import AnalysisManager
+from cfg import successors, reassemble
+from df import bits_to_set
+from graphs import tree_walk
 
 
 def def_blocks(blocks):
@@ -18,28 +20,43 @@ def def_blocks(blocks):
     return dict(out)
 
 
-def get_phis(blocks, df, defs):
+def get_phis(blocks, df, defs, live=None):
     """Find where to insert phi-nodes in the blocks.
 
     Produce a map from block names to variable names that need phi-nodes
     in those blocks. (We will need to generate names and actually insert
     instructions later.)
+
+    If `live` is given, it maps block names to the sets of variables
+    that are live on entry, and only phi-nodes for live variables are
+    inserted ("pruned" SSA). The others would never be used.
     """
     phis = {b: set() for b in blocks}
     for v, v_defs in defs.items():
-        v_defs_list = list(v_defs)
-        for d in v_defs_list:
+        work = list(v_defs)
+        while work:
+            d = work.pop()
             for block in df[d]:
-                # Add a phi-node...
-                if v not in phis[block]:
-                    # ..unless we already did.
+                # Add a phi-node, unless we already did or the variable
+                # is dead there. The phi-node is a new definition.
+                if v not in phis[block] and (live is None or
+                                             v in live[block]):
                     phis[block].add(v)
-                    if block not in v_defs_list:
-                        v_defs_list.append(block)
+                    if block not in v_defs:
+                        work.append(block)
     return phis
 
 
 def ssa_rename(blocks, phis, succ, domtree, args):
+    """Rename every definition in the blocks to a fresh name and every
+    use to the name of its reaching definition, walking the dominator
+    tree `domtree`. Produce maps from block names to maps from variable
+    names to the phi-nodes' arguments (as (predecessor, name) pairs) and
+    destinations.
+
+    Each variable has a stack of names, with the current one on top.
+    On the way back up from a block, we pop the names it pushed.
+    """
     stack = defaultdict(list, {v: [v] for v in args})
     phi_args = {b: {p: [] for p in phis[b]} for b in blocks}
     phi_dests = {b: {p: None for p in phis[b]} for b in blocks}
@@ -48,12 +65,23 @@ def ssa_rename(blocks, phis, succ, domtree, args):
     def _push_fresh(var):
         fresh = '{}.{}'.format(var, counters[var])
         counters[var] += 1
-        stack[var].insert(0, fresh)
+        stack[var].append(fresh)
+        pushed.append(var)
         return fresh
 
-    def _rename(block):
-        # Save stacks.
-        old_stack = {k: list(v) for k, v in stack.items()}
+    # Walk the dominator tree, visiting children in name order. Each
+    # entry in `saved` is the list of variables a block pushed.
+    entry = list(blocks.keys())[0]
+    children = {b: sorted(kids) for b, kids in domtree.items()}
+    saved = []
+    for block, entering in tree_walk(children, entry):
+        if not entering:
+            # Pop the block's names.
+            for var in saved.pop():
+                stack[var].pop()
+            continue
+        pushed = []
+        saved.append(pushed)
 
         # Rename phi-node destinations.
         for p in phis[block]:
@@ -62,7 +90,7 @@ def ssa_rename(blocks, phis, succ, domtree, args):
         for instr in blocks[block]:
             # Rename arguments in normal instructions.
             if 'args' in instr:
-                new_args = [stack[arg][0] for arg in instr['args']]
+                new_args = [stack[arg][-1] for arg in instr['args']]
                 instr['args'] = new_args
 
             # Rename destinations.
@@ -73,17 +101,7 @@ def ssa_rename(blocks, phis, succ, domtree, args):
         for s in succ[block]:
             for p in phis[s]:
                 if stack[p]:
-                    phi_args[s][p].append((block, stack[p][0]))
-
-        # Recursive calls.
-        for b in sorted(domtree[block]):
-            _rename(b)
-
-        # Restore stacks.
-        stack.update(old_stack)
-
-    entry = list(blocks.keys())[0]
-    _rename(entry)
+                    phi_args[s][p].append((block, stack[p][-1]))
 
     return phi_args, phi_dests
 
@@ -96,26 +114,35 @@ def prune_phis(pred, phi_args, phi_dests):
     variable is defined along some but not all paths. These phi-nodes
     are useless because it is illegal to read from the result. And they
     can confuse the out-of-SSA pass because it creates nonsensical
-    copies. This algorithm iteratively eliminates such phi-nodes,
-    propagating through to eliminate consumer phi-nodes until
-    convergence.
+    copies. This algorithm eliminates such phi-nodes, propagating
+    through to eliminate consumer phi-nodes.
     """
-    # We build up a set of new names (phi destinations) to prune, and we
-    # iterate until this set stops growing.
-    old_prune_len = -1
+    # Count each phi's arguments that are not pruned, and find the phis
+    # that use each name.
+    count = {}
+    users = defaultdict(list)
+    work = []
+    for block, args in phi_args.items():
+        for v, v_args in args.items():
+            count[block, v] = len(v_args)
+            for _, a in v_args:
+                users[a].append((block, v))
+            if len(v_args) < len(pred[block]):
+                work.append((block, v))
+
+    # Prune phis with insufficient arguments, and then recount the phis
+    # that use the pruned names.
     prune = set()
-    while len(prune) != old_prune_len:
-        old_prune_len = len(prune)
-
-        # Look at each phi.
-        for block, args in phi_args.items():
-            dests = phi_dests[block]
-            for v, v_args in args.items():
-                # How many non-pruned arguments does this phi have?
-                live_args = [a for _, a in v_args if a not in prune]
-                if len(live_args) < len(pred[block]):
-                    # Prune phis with insufficient arguments.
-                    prune.add(dests[v])
+    while work:
+        block, v = work.pop()
+        dest = phi_dests[block][v]
+        if dest in prune:
+            continue
+        prune.add(dest)
+        for user in users[dest]:
+            count[user] -= 1
+            if count[user] < len(pred[user[0]]):
+                work.append(user)
 
     # Actually delete all phis with pruned destinations.
     for block, args in phi_args.items():
@@ -128,15 +155,13 @@ def prune_phis(pred, phi_args, phi_dests):
 
 def insert_phis(blocks, phi_args, phi_dests, types):
     for block, instrs in blocks.items():
-        for dest, pairs in sorted(phi_args[block].items()):
-            phi = {
-                'op': 'phi',
-                'dest': phi_dests[block][dest],
-                'type': types[dest],
-                'labels': [p[0] for p in pairs],
-                'args': [p[1] for p in pairs],
-            }
-            instrs.insert(0, phi)
+        instrs[:0] = [{
+            'op': 'phi',
+            'dest': phi_dests[block][dest],
+            'type': types[dest],
+            'labels': [p[0] for p in pairs],
+            'args': [p[1] for p in pairs],
+        } for dest, pairs in sorted(phi_args[block].items(), reverse=True)]
 
 
 def get_types(func):
@@ -150,33 +175,55 @@ def get_types(func):
     return types
 
 
-def func_to_ssa(func):
-    blocks = block_map(form_blocks(func['instrs']))
-    add_entry(blocks)
-    add_terminators(blocks)
+def func_to_ssa(func, am=None):
+    """Convert a function to SSA form. Get the CFG and dominance
+    information from the `AnalysisManager` `am`, if there is one.
+    """
+    am = am or AnalysisManager()
+    graph = am.get(func, 'cfg')
+
+    # Blocks that can't be reached from the entry are not in the
+    # dominator tree, so they could not be renamed. Drop them.
+    idom = am.get(func, 'idom')
+    blocks = OrderedDict((name, block) for name, block, d
+                         in zip(graph.names, graph.blocks, idom) if d != -1)
     succ = {name: successors(block[-1]) for name, block in blocks.items()}
-    pred = map_inv(succ)
-    dom = get_dom(succ, list(blocks.keys())[0])
+    pred = {name: [graph.names[p] for p in graph.preds(i) if idom[p] != -1]
+            for i, name in enumerate(graph.names)}
 
-    df = dom_fronts(dom, succ)
+    # Only place phi-nodes for variables that are live into the block.
+    vars, live_in, _ = am.get(func, 'live')
+    live = {name: bits_to_set(mask, vars.names)
+            for name, mask in live_in.items()}
+
+    df = am.get(func, 'front')
     defs = def_blocks(blocks)
     types = get_types(func)
     arg_names = {a['name'] for a in func['args']} if 'args' in func else set()
 
-    phis = get_phis(blocks, df, defs)
-    phi_args, phi_dests = ssa_rename(blocks, phis, succ, dom_tree(dom),
-                                     arg_names)
+    phis = get_phis(blocks, df, defs, live)
+    phi_args, phi_dests = ssa_rename(blocks, phis, succ,
+                                     am.get(func, 'dom_tree'), arg_names)
     prune_phis(pred, phi_args, phi_dests)
     insert_phis(blocks, phi_args, phi_dests, types)
 
     func['instrs'] = reassemble(blocks)
+    am.invalidate(func['name'])
+
+
+def _func_to_ssa(func):
+    func_to_ssa(func)
+    return func
 
 
-def to_ssa(bril):
-    for func in bril['functions']:
-        func_to_ssa(func)
-    return bril
+def to_ssa(bril, names=None, jobs=1):
+    return briltxt.transform_funcs(bril, _func_to_ssa, names, jobs)
 
 
 if __name__ == '__main__':
-    print(json.dumps(to_ssa(json.load(sys.stdin)), indent=2, sort_keys=True))
+    bril, binary = briltxt.read_prog(sys.stdin, lazy=True)
+    args = sys.argv[1:]
+    briltxt.write_prog(
+        to_ssa(bril, briltxt.func_names(args), briltxt.jobs_arg(args)),
+        sys.stdout, binary,
+    )
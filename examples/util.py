@@ -16,3 +16,15 @@ def fresh(seed, names):
         if name not in names:
             return name
         i += 1
+
+
+def fresh_names(seed, names):
+    """Generate an endless sequence of new names that are not in `names`
+    starting with `seed`. Unlike calling `fresh` repeatedly, this does
+    not probe the same candidates again for every name, so generating
+    many names takes linear time.
+    """
+    for i in itertools.count(1):
+        name = seed + str(i)
+        if name not in names:
+            yield name
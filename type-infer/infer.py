@@ -1,9 +1,10 @@
 """Type inference for Bril
 """
-import json
 import sys
 import copy
 
+import briltxt
+
 ARITHMETIC_OPS = ["add", "mul", "sub", "div"]
 COMPARISON_OPS = ["eq", "lt", "gt", "le", "ge"]
 LOGIC_OPS = ["not", "and", "or"]
@@ -92,11 +93,9 @@ def infer_types_func(func):
     # end while
     return typed_func
 
-def infer_types(bril):
-    typed_bril = {"functions": []}
-    for f in bril["functions"]:
-        typed_function = infer_types_func(f)
-        typed_bril["functions"].append(typed_function)
+def infer_types(bril, jobs=1):
+    typed_bril = {"functions": briltxt.map_funcs(infer_types_func,
+                                                 bril["functions"], jobs)}
     return typed_bril
 
 def analyze_vars(typed_func):
@@ -146,8 +145,8 @@ def typecheck(original_bril, typed_bril):
         typecheck_func(original_bril["functions"][i], typed_bril["functions"][i])
 
 if __name__ == '__main__':
-    bril = json.load(sys.stdin)
-    typed_bril = infer_types(bril)
+    bril, binary = briltxt.read_prog(sys.stdin)
+    typed_bril = infer_types(bril, briltxt.jobs_arg(sys.argv[1:]))
     if '-t' in sys.argv:
         typecheck(bril, typed_bril)
-    json.dump(typed_bril, sys.stdout, indent=2, sort_keys=True)
+    briltxt.write_prog(typed_bril, sys.stdout, binary)